@@ -1,9 +1,20 @@
+import base64
 import ujson
 import json
 import requests
 from doct import Document
 import six
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Marks a data value holding a binary array, see encode_arrays
+NDARRAY_KEY = '__ndarray__'
+# Marks a data value the server moved to its blob store
+BLOB_KEY = '__blob__'
+
 
 def get_document(url, doc_type, as_json, contents):
     r = requests.get(url, params=ujson.dumps(contents))
@@ -52,3 +63,40 @@ def doc_or_uid_to_uid(doc_or_uid):
     if not isinstance(doc_or_uid, six.string_types):
         doc_or_uid = doc_or_uid['uid']
     return str(doc_or_uid)
+
+
+def encode_arrays(data):
+    """Replace numpy.ndarray values of a data dict by their binary wire form:
+    a dict with the base64 encoded buffer under ``NDARRAY_KEY`` plus ``dtype``
+    and ``shape``. The server stores the buffer as BSON binary instead of a
+    list of doubles. Returns a new dict, data is left untouched.
+
+    Raises
+    ------
+    ValueError
+        For object arrays, whose buffer holds pointers rather than values"""
+    if np is None or not isinstance(data, dict):
+        return data
+    encoded = dict(data)
+    for key, value in data.items():
+        if isinstance(value, np.ndarray):
+            if value.dtype.hasobject:
+                raise ValueError('Object array {} can not be sent as binary, '
+                                 'convert it to a list'.format(key))
+            # unlike ascontiguousarray, keeps 0-d arrays 0-d
+            arr = np.require(value, requirements='C')
+            encoded[key] = {NDARRAY_KEY: base64.b64encode(arr.data).decode('ascii'),
+                            'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+    return encoded
+
+
+def decode_arrays(data):
+    """Inverse of ``encode_arrays``, in place. Arrays are left in their wire
+    form if numpy is not installed"""
+    if np is None or not isinstance(data, dict):
+        return data
+    for key, value in data.items():
+        if isinstance(value, dict) and NDARRAY_KEY in value:
+            raw = bytearray(base64.b64decode(value[NDARRAY_KEY]))
+            data[key] = np.frombuffer(raw, dtype=value['dtype']).reshape(value['shape'])
+    return data
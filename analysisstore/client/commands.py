@@ -1,14 +1,90 @@
 from __future__ import (absolute_import, unicode_literals, print_function)
 import requests
 import ujson
+from collections import deque
 from itertools import zip_longest
 import six
 import time as ttime
 from requests.exceptions import ConnectionError
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
 from . import asutils
 
 
 
+class Subscription:
+    """Blocking iterator over the documents pushed by the server as they are
+    inserted. Returned by ``AnalysisClient.subscribe``, which documents the
+    subscription keys.
+
+    Runs the websocket on a private IOLoop, so it must not be used from
+    inside a running event loop. Use as a context manager or call close().
+
+    Parameters
+    ----------
+    url : str
+        Address of the subscription endpoint
+    subscription : dict
+        uid per subscription key
+    timeout : float, optional
+        Seconds to wait for a document before raising
+        tornado.util.TimeoutError. Wait forever if None
+    transform : dict, optional
+        Callable per document type applied to pushed documents
+    """
+    def __init__(self, url, subscription, timeout=None, transform=None):
+        self.timeout = timeout
+        self._transform = transform or {}
+        self._pending = deque()
+        self._loop = IOLoop()
+        try:
+            self._conn = self._loop.run_sync(lambda: websocket_connect(url),
+                                             timeout=timeout)
+            self._conn.write_message(ujson.dumps(subscription))
+            # documents are only pushed once the subscription is acknowledged
+            if self._read() is None:
+                raise ConnectionError('Subscription refused by the server')
+        except Exception:
+            self._loop.close()
+            raise
+
+    def _read(self):
+        msg = self._loop.run_sync(self._conn.read_message,
+                                  timeout=self.timeout)
+        return None if msg is None else ujson.loads(msg)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Return the next (doc_type, doc) pair, blocking until one arrives.
+        Stops when the server closes the connection"""
+        while not self._pending:
+            msg = self._read()
+            if msg is None:
+                raise StopIteration
+            transform = self._transform.get(msg['doc_type'])
+            for doc in msg['docs']:
+                if transform is not None:
+                    doc = transform(doc)
+                self._pending.append((msg['doc_type'], doc))
+        return self._pending.popleft()
+
+    def close(self):
+        """Close the websocket and the private IOLoop"""
+        if self._loop is None:
+            return
+        self._conn.close()
+        self._loop.close(all_fds=True)
+        self._loop = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class AnalysisClient:
     """Client used to pass messages between analysisstore server and apps"""
     def __init__(self, config):
@@ -18,7 +94,10 @@ class AnalysisClient:
                              'analysis_tail': self.insert_analysis_tail,
                              'data_reference_header': self.insert_data_reference_header,
                              'data_reference': self.insert_data_reference,
-                             'bulk_data_reference': self.bulk_data_reference_insert}
+                             'bulk_data_reference': self.bulk_data_reference_insert,
+                             'bulk_analysis_header': self.bulk_analysis_header_insert,
+                             'bulk_analysis_tail': self.bulk_analysis_tail_insert,
+                             'bulk_data_reference_header': self.bulk_data_reference_header_insert}
         self._find_dict = {'analysis_header': self.find_analysis_header,
                            'analysis_tail': self.find_analysis_tail,
                            'data_reference_header': self.find_data_reference_header,
@@ -49,6 +128,11 @@ class AnalysisClient:
         """URL for data reference header handler"""
         return self._host_url + 'data_reference_header'
 
+    @property
+    def admin_url(self):
+        """URL for admin handler"""
+        return self._host_url + 'admin'
+
     def _grouper(self, iterable, n, fillvalue=None):
         """Collect data into fixed-length chunks or blocks"""
         args = [iter(iterable)] * n
@@ -71,6 +155,13 @@ class AnalysisClient:
             doc_or_uid = doc_or_uid['uid']
         return str(doc_or_uid)
 
+    def _decode_data_reference(self, doc):
+        """Turn binary array values of a data_reference back into
+        numpy.ndarray, in place"""
+        if 'data' in doc:
+            asutils.decode_arrays(doc['data'])
+        return doc
+
     def connection_status(self):
         """Returns the connection status
 
@@ -154,6 +245,31 @@ class AnalysisClient:
         r.raise_for_status()
         return r.json()
 
+    def get_stream(self, url, query):
+        """Gets newline delimited documents from the server as they arrive.
+        For query operations on large result sets
+        Parameters
+        ----------
+        url : str
+            The address of the handler
+        query : dict
+            A special signature and data for this service
+        Raises
+        ------
+        requests.HTTPError
+            In case get fails (status_code != 200)
+        Yields
+        ------
+        dict
+            Documents in the order the server sends them
+        """
+        with requests.get(url, params=ujson.dumps(dict(query, stream=True)),
+                          stream=True) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if line:
+                    yield ujson.loads(line)
+
     def insert_analysis_header(self, uid, time, provenance, **kwargs):
         """
         Create the entry point for data analysis.
@@ -250,6 +366,9 @@ class AnalysisClient:
             Unique identifier for data_reference document
         time : float
             Time document was created. Server fills up this field if not provided
+        data : dict
+            Analysis results. numpy.ndarray values are shipped and stored as
+            binary buffers with their dtype and shape
         kwargs : dict
             Additional fields
 
@@ -260,25 +379,136 @@ class AnalysisClient:
         """
         dhdr = self._doc_or_uid_to_uid(data_header)
         payload = dict(data_reference_header=dhdr,
-                       uid=uid, time=time, data=data, timestamps=timestamps,
-                       **kwargs)
+                       uid=uid, time=time, data=asutils.encode_arrays(data),
+                       timestamps=timestamps, **kwargs)
         params = self._post_factory(payload=payload,
                                     signature='insert_data_reference')
-        uid = asutils.post_document(url=self.dref_url, contents=params)
-        return uid
+        return asutils.post_document(url=self.dref_url, contents=params)['result']
 
     def bulk_data_reference_insert(self, data_header, data_references,
-                                   **kwargs):
+                                   write_concern=None, **kwargs):
+        """
+        Insert many data reference documents in a single request. The server
+        writes them in size bounded batches and reports per document outcome.
+
+        Parameters
+        ----------
+        data_header : doct.Document or uid
+            data_reference_header document the references point to
+        data_references : list
+            data_reference documents, each with a uid. numpy.ndarray values
+            of ``data`` are shipped and stored as binary buffers
+        write_concern : dict, optional
+            WriteConcern options (w, j, wtimeout) overriding the server
+            configuration for this request. w=0 trades durability and error
+            reporting for throughput, and switches off ``since`` polling of
+            the collection
+
+        Returns
+        -------
+        dict
+            ``inserted`` lists the uids written, ``failed`` lists uid/error
+            pairs (e.g. duplicate uids) that can be retried
+        """
         dhdr = self._doc_or_uid_to_uid(data_header)
-        uids = []
-        for d in data_references:
-            d['data_reference_header'] = dhdr
-            uids.append(d['uid'])
+        # copies, the documents of the caller keep their arrays
+        data_references = [dict(d, data_reference_header=dhdr,
+                                data=asutils.encode_arrays(d['data']))
+                           for d in data_references]
         payload = dict(data_header=dhdr, data_references=data_references)
+        if write_concern is not None:
+            payload['write_concern'] = write_concern
         params = self._post_factory(payload=payload,
                                     signature='bulk_data_reference_insert')
-        asutils.post_document(url=self.dref_url, contents=params)
-        return uids
+        return asutils.post_document(url=self.dref_url, contents=params)['result']
+
+    def bulk_analysis_header_insert(self, analysis_headers, write_concern=None):
+        """
+        Insert many analysis header documents in a single request.
+
+        Parameters
+        ----------
+        analysis_headers : list
+            analysis_header documents, each with uid, time and provenance
+        write_concern : dict, optional
+            WriteConcern options (w, j, wtimeout) overriding the server
+            configuration for this request. w=0 trades durability and error
+            reporting for throughput, and switches off ``since`` polling of
+            the collection
+
+        Returns
+        -------
+        dict
+            ``inserted`` lists the uids written, ``failed`` lists uid/error
+            pairs that can be retried
+        """
+        payload = dict(analysis_headers=analysis_headers)
+        if write_concern is not None:
+            payload['write_concern'] = write_concern
+        params = self._post_factory(payload=payload,
+                                    signature='bulk_analysis_header_insert')
+        return asutils.post_document(url=self.aheader_url, contents=params)['result']
+
+    def bulk_analysis_tail_insert(self, analysis_tails, write_concern=None):
+        """
+        Insert many analysis tail documents in a single request.
+
+        Parameters
+        ----------
+        analysis_tails : list
+            analysis_tail documents, each with uid, time, analysis_header and
+            exit_status
+        write_concern : dict, optional
+            WriteConcern options (w, j, wtimeout) overriding the server
+            configuration for this request. w=0 trades durability and error
+            reporting for throughput, and switches off ``since`` polling of
+            the collection
+
+        Returns
+        -------
+        dict
+            ``inserted`` lists the uids written, ``failed`` lists uid/error
+            pairs that can be retried
+        """
+        for d in analysis_tails:
+            d['analysis_header'] = self._doc_or_uid_to_uid(d['analysis_header'])
+        payload = dict(analysis_tails=analysis_tails)
+        if write_concern is not None:
+            payload['write_concern'] = write_concern
+        params = self._post_factory(payload=payload,
+                                    signature='bulk_analysis_tail_insert')
+        return asutils.post_document(url=self.atail_url, contents=params)['result']
+
+    def bulk_data_reference_header_insert(self, data_reference_headers,
+                                          write_concern=None):
+        """
+        Insert many data reference header documents in a single request.
+
+        Parameters
+        ----------
+        data_reference_headers : list
+            data_reference_header documents, each with uid, time,
+            analysis_header and data_keys
+        write_concern : dict, optional
+            WriteConcern options (w, j, wtimeout) overriding the server
+            configuration for this request. w=0 trades durability and error
+            reporting for throughput, and switches off ``since`` polling of
+            the collection
+
+        Returns
+        -------
+        dict
+            ``inserted`` lists the uids written, ``failed`` lists uid/error
+            pairs that can be retried
+        """
+        for d in data_reference_headers:
+            d['analysis_header'] = self._doc_or_uid_to_uid(d['analysis_header'])
+        payload = dict(data_reference_headers=data_reference_headers)
+        if write_concern is not None:
+            payload['write_concern'] = write_concern
+        params = self._post_factory(payload=payload,
+                                    signature='bulk_data_reference_header_insert')
+        return asutils.post_document(url=self.dref_header_url, contents=params)['result']
 
     def update_analysis_header(self, query, update):
         """ Not yet implemented"""
@@ -288,26 +518,406 @@ class AnalysisClient:
         """Not yet implemented"""
         raise NotImplementedError('Not sure if this is a good idea. Convince me that it is')
 
-    def find_analysis_header(self, **kwargs):
-        """Given a set of parameters, return analysis header(s) that match the provided criteria"""
+    def find_analysis_header(self, fields=None, **kwargs):
+        """Given a set of parameters, return analysis header(s) that match the provided criteria.
+        If ``fields`` is given, only those fields (dotted paths allowed) plus
+        time and uid are returned. With ``since`` (0, then the ``since``
+        returned by the previous call) only documents inserted in between
+        are returned, as ``{'data': [...], 'since': cursor}``. Documents
+        stored before insertion sequences existed are never returned. since
+        is refused by servers running several workers"""
+        if fields is not None:
+            kwargs['fields'] = list(fields)
         q = self._query_factory(kwargs, signature='find_analysis_header')
         return self.get(self.aheader_url, q)
 
-    def find_analysis_tail(self, **kwargs):
-        """Given a set of parameters, return analysis tail(s) that match the provided criteria"""
+    def find_analysis_tail(self, fields=None, **kwargs):
+        """Given a set of parameters, return analysis tail(s) that match the provided criteria.
+        If ``fields`` is given, only those fields (dotted paths allowed) plus
+        time and uid are returned. With ``since`` (0, then the ``since``
+        returned by the previous call) only documents inserted in between
+        are returned, as ``{'data': [...], 'since': cursor}``. Documents
+        stored before insertion sequences existed are never returned. since
+        is refused by servers running several workers"""
+        if fields is not None:
+            kwargs['fields'] = list(fields)
         q = self._query_factory(kwargs, signature='find_analysis_tail')
         return self.get(self.atail_url, q)
 
-    def find_data_reference_header(self, **kwargs):
-        """Given a set of parameters, return data reference header(s) that match the provided criteria"""
+    def wait_analysis_tail(self, analysis_header, timeout=30):
+        """Block until the analysis is finished, i.e. an analysis tail of the
+        analysis header is inserted, or until timeout. The server holds each
+        request open instead of being polled
+
+        Parameters
+        ----------
+        analysis_header : doct.Document or str
+            AnalysisHeader document or uid
+        timeout : float, optional
+            Seconds to wait at most
+
+        Returns
+        -------
+        dict or None
+            The most recent analysis tail, None if none arrived in time
+        """
+        uid = self._doc_or_uid_to_uid(analysis_header)
+        deadline = ttime.monotonic() + timeout
+        while True:
+            remaining = deadline - ttime.monotonic()
+            # the server caps how long a single request is held
+            q = self._query_factory(dict(uid=uid, timeout=max(remaining, 0.001)),
+                                    signature='wait_analysis_tail')
+            tails = self.get(self.atail_url, q)
+            if tails:
+                return tails[0]
+            if deadline - ttime.monotonic() <= 0:
+                return None
+
+    def find_data_reference_header(self, fields=None, **kwargs):
+        """Given a set of parameters, return data reference header(s) that match the provided criteria.
+        If ``fields`` is given, only those fields (dotted paths allowed) plus
+        time and uid are returned. With ``since`` (0, then the ``since``
+        returned by the previous call) only documents inserted in between
+        are returned, as ``{'data': [...], 'since': cursor}``. Documents
+        stored before insertion sequences existed are never returned. since
+        is refused by servers running several workers"""
+        if fields is not None:
+            kwargs['fields'] = list(fields)
         q = self._query_factory(kwargs, signature='find_data_reference_header')
         return self.get(self.dref_header_url, q)
 
-    def find_data_reference(self, **kwargs):
-        """Given a set of parameters, return data reference(s) that match the provided criteria"""
+    def find_data_reference(self, fields=None, **kwargs):
+        """Given a set of parameters, return data reference(s) that match the provided criteria.
+        If ``fields`` is given, only those fields (dotted paths allowed) plus
+        time and uid are returned. With ``since`` (0, then the ``since``
+        returned by the previous call) only documents inserted in between
+        are returned, as ``{'data': [...], 'since': cursor}``. Documents
+        stored before insertion sequences existed are never returned. since
+        is refused by servers running several workers"""
+        if fields is not None:
+            kwargs['fields'] = list(fields)
         q = self._query_factory(kwargs, signature='find_data_reference')
+        res = self.get(self.dref_url, q)
+        for doc in (res['data'] if isinstance(res, dict) else res):
+            self._decode_data_reference(doc)
+        return res
+
+    def get_analysis_tree(self, analysis_header, include_references=False):
+        """Fetch an analysis header, its tails, its data reference headers and
+        optionally their data references in a single request
+
+        Parameters
+        ----------
+        analysis_header : doct.Document or str
+            AnalysisHeader document or uid
+        include_references : bool or int, optional
+            True for all data references, a positive integer for at most that
+            many (most recent first) per data reference header
+
+        Returns
+        -------
+        dict
+            ``analysis_header``, ``analysis_tails``, ``data_reference_headers``
+            and, if requested, ``data_references`` keyed on data reference
+            header uid
+        """
+        uid = self._doc_or_uid_to_uid(analysis_header)
+        q = self._query_factory(dict(uid=uid,
+                                     include_references=include_references),
+                                signature='get_analysis_tree')
+        tree = self.get(self.aheader_url, q)
+        for docs in tree.get('data_references', {}).values():
+            for doc in docs:
+                self._decode_data_reference(doc)
+        return tree
+
+    def index_report(self):
+        """Report missing and unused indexes per collection on the server
+
+        Returns
+        -------
+        dict
+            Keyed on collection name, with ``missing`` key specs and
+            ``unused`` index names
+        """
+        q = self._query_factory({}, signature='index_report')
+        return self.get(self.admin_url, q)
+
+    def explain(self, signature, **kwargs):
+        """Return the database query plan of a find_* query, e.g. to spot
+        collection scans and in-memory sorts
+
+        Parameters
+        ----------
+        signature : str
+            find_<collection> signature, e.g. 'find_data_reference'
+        kwargs : dict
+            Query as passed to the find_* method, including ``limit``,
+            ``next`` and ``fields``
+
+        Returns
+        -------
+        dict
+            Output of the database explain command
+        """
+        q = self._query_factory(dict(signature=signature, payload=kwargs),
+                                signature='explain')
+        return self.get(self.admin_url, q)
+
+    def cache_stats(self):
+        """Hit/miss counters and sizes of the server caches
+
+        Returns
+        -------
+        dict
+            Verified header caches keyed on collection name and, if the
+            server caches responses, the response cache under ``response``
+        """
+        q = self._query_factory({}, signature='cache_stats')
+        return self.get(self.admin_url, q)
+
+    def count_analysis_header(self, **kwargs):
+        """Given a set of parameters, return the number of analysis headers that match
+        the provided criteria, without transferring them"""
+        q = self._query_factory(kwargs, signature='count_analysis_header')
+        return self.get(self.aheader_url, q)
+
+    def count_analysis_tail(self, **kwargs):
+        """Given a set of parameters, return the number of analysis tails that match
+        the provided criteria, without transferring them"""
+        q = self._query_factory(kwargs, signature='count_analysis_tail')
+        return self.get(self.atail_url, q)
+
+    def count_data_reference_header(self, **kwargs):
+        """Given a set of parameters, return the number of data reference headers that match
+        the provided criteria, without transferring them"""
+        q = self._query_factory(kwargs, signature='count_data_reference_header')
+        return self.get(self.dref_header_url, q)
+
+    def count_data_reference(self, **kwargs):
+        """Given a set of parameters, return the number of data references that match
+        the provided criteria, without transferring them"""
+        q = self._query_factory(kwargs, signature='count_data_reference')
+        return self.get(self.dref_url, q)
+
+    def distinct_analysis_header(self, key, **kwargs):
+        """Given a key (dotted paths allowed) and a set of parameters, return
+        the distinct values of key among the matching analysis headers"""
+        q = self._query_factory(dict(kwargs, key=key),
+                                signature='distinct_analysis_header')
+        return self.get(self.aheader_url, q)
+
+    def distinct_analysis_tail(self, key, **kwargs):
+        """Given a key (dotted paths allowed) and a set of parameters, return
+        the distinct values of key among the matching analysis tails"""
+        q = self._query_factory(dict(kwargs, key=key),
+                                signature='distinct_analysis_tail')
+        return self.get(self.atail_url, q)
+
+    def distinct_data_reference_header(self, key, **kwargs):
+        """Given a key (dotted paths allowed) and a set of parameters, return
+        the distinct values of key among the matching data reference headers"""
+        q = self._query_factory(dict(kwargs, key=key),
+                                signature='distinct_data_reference_header')
+        return self.get(self.dref_header_url, q)
+
+    def distinct_data_reference(self, key, **kwargs):
+        """Given a key (dotted paths allowed) and a set of parameters, return
+        the distinct values of key among the matching data references"""
+        q = self._query_factory(dict(kwargs, key=key),
+                                signature='distinct_data_reference')
+        return self.get(self.dref_url, q)
+
+    def aggregate_data_reference(self, pipeline):
+        """Run an aggregation pipeline over data references on the server and
+        return only its result
+
+        Parameters
+        ----------
+        pipeline : list
+            Mongo aggregation stages. Only $match, $group, $bucket, $sort and
+            $limit are accepted by the server
+
+        Returns
+        -------
+        list
+            Result documents of the pipeline
+        """
+        q = self._query_factory(dict(pipeline=pipeline),
+                                signature='aggregate_data_reference')
+        return self.get(self.dref_url, q)
+
+    def get_data_reference_summary(self, data_reference_header):
+        """Return count, time range and seq_num range of the data references
+        of a data reference header without querying the references
+
+        Parameters
+        ----------
+        data_reference_header : doct.Document or str
+            DataReferenceHeader document or uid
+
+        Returns
+        -------
+        dict
+            count, time_min, time_max and, if the references carry seq_num,
+            seq_num_min and seq_num_max
+        """
+        dhdr = self._doc_or_uid_to_uid(data_reference_header)
+        q = self._query_factory(dict(data_reference_header=dhdr),
+                                signature='get_data_reference_summary')
         return self.get(self.dref_url, q)
 
+    def get_data_reference_blob(self, blob):
+        """Fetch a data value the server stored as a blob because of its size
+
+        Parameters
+        ----------
+        blob : dict or str
+            The ``{'__blob__': key, 'size': nbytes}`` reference found in a
+            data reference's data, or its key
+
+        Returns
+        -------
+        object
+            The original data value
+        """
+        if isinstance(blob, dict):
+            blob = blob[asutils.BLOB_KEY]
+        q = self._query_factory(dict(key=blob),
+                                signature='get_data_reference_blob')
+        res = asutils.decode_arrays(self.get(self.dref_url, q))
+        return res['value']
+
+    def resolve_blobs(self, data_reference):
+        """Replace, in place, the blob references in a data reference's data by
+        their values. Each blob costs one request, so only resolve the
+        documents whose payload is needed."""
+        data = data_reference.get('data', {})
+        for key, value in data.items():
+            if isinstance(value, dict) and asutils.BLOB_KEY in value:
+                data[key] = self.get_data_reference_blob(value)
+        return data_reference
+
+    def _iter_pages(self, url, signature, page_size, query):
+        """Lazily walk a find_* query one page at a time.
+
+        Parameters
+        ----------
+        url : str
+            The address of the handler
+        signature : str
+            Signature of the find_* routine
+        page_size : int
+            Number of documents fetched per request
+        query : dict
+            Query in mongo query format
+
+        Yields
+        ------
+        dict
+            Documents in (time, uid) descending order
+        """
+        token = None
+        while True:
+            payload = dict(query, limit=page_size)
+            if token is not None:
+                payload['next'] = token
+            page = self.get(url, self._query_factory(payload, signature))
+            for doc in page['data']:
+                yield doc
+            token = page['next']
+            if token is None:
+                return
+
+    def iter_analysis_header(self, page_size=1000, **kwargs):
+        """Lazy version of find_analysis_header fetching pages on demand"""
+        return self._iter_pages(self.aheader_url, 'find_analysis_header',
+                                page_size, kwargs)
+
+    def iter_analysis_tail(self, page_size=1000, **kwargs):
+        """Lazy version of find_analysis_tail fetching pages on demand"""
+        return self._iter_pages(self.atail_url, 'find_analysis_tail',
+                                page_size, kwargs)
+
+    def iter_data_reference_header(self, page_size=1000, **kwargs):
+        """Lazy version of find_data_reference_header fetching pages on demand"""
+        return self._iter_pages(self.dref_header_url,
+                                'find_data_reference_header', page_size, kwargs)
+
+    def iter_data_reference(self, page_size=1000, **kwargs):
+        """Lazy version of find_data_reference fetching pages on demand"""
+        pages = self._iter_pages(self.dref_url, 'find_data_reference',
+                                 page_size, kwargs)
+        return (self._decode_data_reference(doc) for doc in pages)
+
+    def stream(self, doc_type, query):
+        """
+        Given document type and search parameters, yield the matching docs as
+        the server streams them instead of receiving the whole result at once.
+
+        Parameters
+        ----------
+        doc_type : str
+            Document type query will be performed on
+        query : dict
+
+        Yields
+        ------
+        dict
+            Documents in (time, uid) descending order
+        """
+        urls = {'analysis_header': self.aheader_url,
+                'analysis_tail': self.atail_url,
+                'data_reference_header': self.dref_header_url,
+                'data_reference': self.dref_url}
+        try:
+            url = urls[doc_type]
+        except KeyError:
+            raise KeyError('Not a valid document type for stream')
+        q = self._query_factory(query, signature='find_' + doc_type)
+        if doc_type == 'data_reference':
+            return (self._decode_data_reference(doc)
+                    for doc in self.get_stream(url, q))
+        return self.get_stream(url, q)
+
+    def subscribe(self, data_reference_header=None, analysis_header=None,
+                  timeout=None):
+        """Receive documents as they are inserted instead of polling find_*
+
+        Parameters
+        ----------
+        data_reference_header : doct.Document or str, optional
+            Receive the data references of this data reference header
+        analysis_header : doct.Document or str, optional
+            Receive the data reference headers, analysis tails and data
+            references of this analysis header
+        timeout : float, optional
+            Seconds to wait for a document before raising
+            tornado.util.TimeoutError. Wait forever if None
+
+        Returns
+        -------
+        Subscription
+            Iterator of (doc_type, doc) pairs, in the form the documents were
+            inserted. Only inserts handled by the server process the
+            subscription is connected to are pushed
+        """
+        subscription = dict()
+        if data_reference_header is not None:
+            subscription['data_reference_header'] = \
+                self._doc_or_uid_to_uid(data_reference_header)
+        if analysis_header is not None:
+            subscription['analysis_header'] = \
+                self._doc_or_uid_to_uid(analysis_header)
+        if not subscription:
+            raise ValueError('Subscribe by data_reference_header and/or '
+                             'analysis_header')
+        url = 'ws://{}:{}/subscribe'.format(self.host, self.port)
+        return Subscription(url, subscription, timeout=timeout,
+                            transform={'data_reference':
+                                       self._decode_data_reference})
+
     def insert(self, doc_type, **kwargs):
         raise NotImplementedError('Coming soon')
 
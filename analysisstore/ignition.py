@@ -1,18 +1,34 @@
 from __future__ import (absolute_import, print_function, unicode_literals)
 import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
 import tornado.web
 import sys
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 from .server.astore import AStore
+from .server.cache import ResponseCache, DEFAULT_UID_CACHE_SIZE
+from .server.metrics import Metrics, start_lag_monitor
+from .server.subscriptions import Subscriptions, Waiters
 from  analysisstore.server.engine import (AnalysisHeaderHandler,
                                           AnalysisTailHandler,
                                           DataReferenceHeaderHandler,
                                           DataReferenceHandler,
-                                          ConnStatHandler
+                                          ConnStatHandler,
+                                          AdminHandler,
+                                          MetricsHandler,
+                                          SubscriptionHandler,
+                                          DEFAULT_SLOW_QUERY_MS
                                           )
 from analysisstore.server.conf import load_configuration
 
+# Number of threads pymongo calls are dispatched to, unless configured
+DEFAULT_STORAGE_POOL_SIZE = 8
+
+
 def start_server(config=None):
     """
     Amostra service startup script.
@@ -44,6 +60,33 @@ def start_server(config=None):
                             help='Local timezone')
         parser.add_argument('--service_port', dest='service_port', type=int,
                             help='port listen to for clients')
+        parser.add_argument('--storage_pool_size', dest='storage_pool_size', type=int,
+                            help='number of threads running blocking database calls')
+        parser.add_argument('--header_cache_size', dest='header_cache_size', type=int,
+                            help='number of verified header uids cached, 0 to disable')
+        parser.add_argument('--parent_cache_size', dest='parent_cache_size', type=int,
+                            help='number of analysis headers of data reference headers '
+                                 'cached for subscriptions, 0 to disable')
+        parser.add_argument('--write_concern', dest='write_concern', type=json.loads,
+                            help='write concern as json, e.g. \'{"w": 1, "data_reference": {"w": 0}}\'')
+        parser.add_argument('--blob_threshold', dest='blob_threshold', type=int,
+                            help='size in bytes above which data values are stored as blobs')
+        parser.add_argument('--blob_store', dest='blob_store', type=str,
+                            help="'gridfs' (default) or a directory for blob files")
+        parser.add_argument('--compression', dest='compression', type=str,
+                            help="codec compressing large data and timestamps values, 'zlib' or 'zstd'")
+        parser.add_argument('--compression_threshold', dest='compression_threshold', type=int,
+                            help='size in bytes above which a data or timestamps value is compressed')
+        parser.add_argument('--bucket_size', dest='bucket_size', type=int,
+                            help='store data references in buckets of this many entries')
+        parser.add_argument('--response_cache_size', dest='response_cache_size', type=int,
+                            help='bytes of query responses cached, single worker only')
+        parser.add_argument('--slow_query_ms', dest='slow_query_ms', type=float,
+                            help='log storage calls slower than this many milliseconds')
+        parser.add_argument('--validate', dest='validate', action='store_const',
+                            const=True, help='validate inserted documents against the schemas')
+        parser.add_argument('--workers', dest='workers', type=int,
+                            help='number of pre-forked server processes, 0 for one per core')
         parser.add_argument('--log-file_prefix', dest='log_file_prefix', type=str,
                             help='Log file name that tornado logs are dumped')
         parser.add_argument(
@@ -58,6 +101,32 @@ def start_server(config=None):
             config['timezone'] = args.timezone
         if args.service_port is not None:
             config['service_port'] = args.service_port
+        if args.storage_pool_size is not None:
+            config['storage_pool_size'] = args.storage_pool_size
+        if args.header_cache_size is not None:
+            config['header_cache_size'] = args.header_cache_size
+        if args.parent_cache_size is not None:
+            config['parent_cache_size'] = args.parent_cache_size
+        if args.write_concern is not None:
+            config['write_concern'] = args.write_concern
+        if args.blob_threshold is not None:
+            config['blob_threshold'] = args.blob_threshold
+        if args.blob_store is not None:
+            config['blob_store'] = args.blob_store
+        if args.compression is not None:
+            config['compression'] = args.compression
+        if args.compression_threshold is not None:
+            config['compression_threshold'] = args.compression_threshold
+        if args.bucket_size is not None:
+            config['bucket_size'] = args.bucket_size
+        if args.response_cache_size is not None:
+            config['response_cache_size'] = args.response_cache_size
+        if args.slow_query_ms is not None:
+            config['slow_query_ms'] = args.slow_query_ms
+        if args.validate is not None:
+            config['validate'] = args.validate
+        if args.workers is not None:
+            config['workers'] = args.workers
         config["testing"] = args.testing or None
         config["log_file_prefix"] = args.log_file_prefix or None
         if not config:
@@ -65,15 +134,68 @@ def start_server(config=None):
                 "No configuration provided. Provide config file or command line args"
             )
     tornado.options.parse_command_line({'log_file_prefix': config["log_file_prefix"]})
-    cfg = dict(uri=config['mongo_uri'], database=config['database'])
-    astore = AStore(cfg, testing=config["testing"])
-    application = tornado.web.Application([(r'/analysis_header', AnalysisHeaderHandler),
-                                           (r'/data_reference', DataReferenceHandler),
-                                          (r'/data_reference_header',
-                                           DataReferenceHeaderHandler),
-                                          (r'/analysis_tail', AnalysisTailHandler),
-                                          (r'/is_connected', ConnStatHandler)
-                                          ], astore=astore)
+    if config.get('workers', 1) != 1 and config.get('response_cache_size'):
+        # inserts are only seen by the cache of the worker handling them
+        raise ValueError('response_cache_size requires a single worker')
+    # Bind before forking so that every worker accepts on the same socket
+    sockets = tornado.netutil.bind_sockets(config['service_port'])
+    workers = config.get('workers', 1)
+    if workers != 1:
+        # The parent stays behind as supervisor and restarts dead workers.
+        # No IOLoop or MongoClient may exist before this point.
+        tornado.process.fork_processes(workers)
+    application = make_application(config)
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    start_lag_monitor(application.settings['metrics'])
     print('Starting Analysisstore service with configuration ', config)
-    application.listen(config['service_port'])
     tornado.ioloop.IOLoop.current().start()
+
+
+def make_application(config):
+    """Create the AStore, storage executor and tornado application for one
+    server process. With multiple workers this runs after the fork so each
+    worker owns its MongoClient.
+
+    Parameters
+    ----------
+    config: dict
+        Service configuration as assembled by ``start_server``
+
+    Returns
+    -------
+    tornado.web.Application
+        Application with all handlers registered
+    """
+    cfg = dict(uri=config['mongo_uri'], database=config['database'])
+    for key in ('header_cache_size', 'write_concern', 'blob_threshold',
+                'blob_store', 'compression', 'compression_threshold',
+                'bucket_size', 'validate'):
+        if config.get(key) is not None:
+            cfg[key] = config[key]
+    astore = AStore(cfg, testing=config["testing"])
+    astore.ensure_indexes()
+    executor = ThreadPoolExecutor(max_workers=config.get('storage_pool_size',
+                                                         DEFAULT_STORAGE_POOL_SIZE))
+    response_cache = None
+    if config.get('response_cache_size'):
+        response_cache = ResponseCache(config['response_cache_size'])
+    return tornado.web.Application([(r'/analysis_header', AnalysisHeaderHandler),
+                                    (r'/data_reference', DataReferenceHandler),
+                                    (r'/data_reference_header',
+                                     DataReferenceHeaderHandler),
+                                    (r'/analysis_tail', AnalysisTailHandler),
+                                    (r'/is_connected', ConnStatHandler),
+                                    (r'/admin', AdminHandler),
+                                    (r'/metrics', MetricsHandler),
+                                    (r'/subscribe', SubscriptionHandler)
+                                    ], astore=astore, executor=executor,
+                                   metrics=Metrics(),
+                                   subscriptions=Subscriptions(
+                                       config.get('parent_cache_size',
+                                                  DEFAULT_UID_CACHE_SIZE)),
+                                   waiters=Waiters(),
+                                   workers=config.get('workers', 1),
+                                   response_cache=response_cache,
+                                   slow_query_ms=config.get('slow_query_ms',
+                                                            DEFAULT_SLOW_QUERY_MS))
@@ -1,9 +1,133 @@
-from pymongo import MongoClient, DESCENDING
+from pymongo import (MongoClient, ASCENDING, DESCENDING, WriteConcern,
+                     ReturnDocument)
 import pymongo
+import bson
+from bson import json_util
+from contextlib import contextmanager
 import jsonschema
 import json
+import logging
 import six
-from .utils import AnalysisstoreException
+import threading
+from .cache import UidCache, DEFAULT_UID_CACHE_SIZE
+from .blobs import GridFSBlobStore, FileBlobStore
+from .payload import (arrays_to_binary, arrays_to_base64, offload_blobs,
+                      load_blob, check_codec, compress_values,
+                      decompress_values)
+from .utils import (AnalysisstoreException, encode_page_token,
+                    decode_page_token)
+from .validation import compile_validators
+
+logger = logging.getLogger(__name__)
+
+
+# Declarative index specification per collection. Every find_* sorts on
+# (time, uid) DESCENDING and the foreign key lookups are followed by the same
+# sort, so the compound indexes cover both the filter and the sort. find_*
+# with ``since`` filters and sorts on insert_seq, optionally after the
+# foreign key.
+INDEXES = {
+    'analysis_header': [
+        dict(keys=[('uid', ASCENDING)], unique=True),
+        dict(keys=[('time', DESCENDING), ('uid', DESCENDING)]),
+        dict(keys=[('insert_seq', ASCENDING)]),
+    ],
+    'analysis_tail': [
+        dict(keys=[('uid', ASCENDING)], unique=True),
+        dict(keys=[('time', DESCENDING), ('uid', DESCENDING)]),
+        dict(keys=[('analysis_header', ASCENDING), ('time', DESCENDING),
+                   ('uid', DESCENDING)]),
+        dict(keys=[('insert_seq', ASCENDING)]),
+        dict(keys=[('analysis_header', ASCENDING), ('insert_seq', ASCENDING)]),
+    ],
+    'data_reference_header': [
+        dict(keys=[('uid', ASCENDING)], unique=True),
+        dict(keys=[('time', DESCENDING), ('uid', DESCENDING)]),
+        dict(keys=[('analysis_header', ASCENDING), ('time', DESCENDING),
+                   ('uid', DESCENDING)]),
+        dict(keys=[('insert_seq', ASCENDING)]),
+        dict(keys=[('analysis_header', ASCENDING), ('insert_seq', ASCENDING)]),
+    ],
+    'data_reference': [
+        dict(keys=[('uid', ASCENDING)], unique=True),
+        dict(keys=[('time', DESCENDING), ('uid', DESCENDING)]),
+        dict(keys=[('data_reference_header', ASCENDING), ('time', DESCENDING),
+                   ('uid', DESCENDING)]),
+        dict(keys=[('insert_seq', ASCENDING)]),
+        dict(keys=[('data_reference_header', ASCENDING),
+                   ('insert_seq', ASCENDING)]),
+    ],
+    # per header summary of data_reference, see AStore._update_summary
+    'data_reference_summary': [
+        dict(keys=[('data_reference_header', ASCENDING)], unique=True),
+    ],
+    # bucketed layout of data_reference, see AStore._bucket_insert
+    'data_reference_bucket': [
+        dict(keys=[('data_reference_header', ASCENDING), ('count', ASCENDING)]),
+        dict(keys=[('data_reference_header', ASCENDING),
+                   ('time_max', DESCENDING)]),
+        dict(keys=[('data_reference_header', ASCENDING),
+                   ('time_min', ASCENDING)]),
+        dict(keys=[('entries.uid', ASCENDING)]),
+        dict(keys=[('data_reference_header', ASCENDING),
+                   ('entries.insert_seq', ASCENDING)]),
+    ],
+}
+
+# insert_seq values reserved per counter round trip, handed out locally
+SEQ_BLOCK_SIZE = 1000
+
+# Bounds of a single insert_many batch in bulk inserts. The byte bound keeps
+# batches well below the 48MB wire message limit of mongod.
+BULK_BATCH_COUNT = 1000
+BULK_BATCH_BYTES = 8 * 1024 * 1024
+# Largest document mongod accepts
+MAX_BSON_SIZE = 16 * 1024 * 1024
+
+# Aggregation stages clients may run through aggregate_data_reference
+AGGREGATION_STAGES = frozenset(['$match', '$group', '$bucket', '$sort', '$limit'])
+# Operators running server side code or reaching into other collections,
+# refused at any depth of a client supplied pipeline
+FORBIDDEN_OPERATORS = frozenset(['$where', '$function', '$accumulator', '$out',
+                                 '$merge', '$lookup', '$graphLookup',
+                                 '$unionWith'])
+
+# Conditions on data_reference fields that can be tested against the entries
+# of a bucket to skip buckets without matching entries
+BUCKET_PUSHDOWN_FIELDS = ('uid', 'time', 'insert_seq')
+BUCKET_PUSHDOWN_OPERATORS = frozenset(['$eq', '$in', '$lt', '$lte', '$gt', '$gte'])
+
+# Size in bytes of the BSON encoded data or timestamps value above which it
+# is compressed, if compression is enabled
+DEFAULT_COMPRESSION_THRESHOLD = 4096
+# data_reference fields whose values may be stored compressed, so that a
+# value can only be used whole, not looked into
+COMPRESSED_FIELDS = ('data', 'timestamps')
+
+
+def _is_inside_value(path):
+    """Whether a dotted path reaches below a value of COMPRESSED_FIELDS,
+    e.g. data.img.0 rather than data.img"""
+    parts = path.split('.')
+    return parts[0] in COMPRESSED_FIELDS and len(parts) > 2
+
+
+def _compressed_paths(item):
+    """Yield the paths below values of COMPRESSED_FIELDS used by a query or
+    an aggregation pipeline, as dict keys or $field references"""
+    stack = [item]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            for key, value in item.items():
+                if _is_inside_value(key):
+                    yield key
+                stack.append(value)
+        elif isinstance(item, list):
+            stack.extend(item)
+        elif (isinstance(item, six.string_types) and item.startswith('$') and
+              _is_inside_value(item[1:])):
+            yield item[1:]
 
 
 class AStore:
@@ -15,7 +139,15 @@ class AStore:
         Parameters
         -----------
         config: dict
-            uri in string format, and database
+            uri in string format, and database. Optionally header_cache_size,
+            the number of verified header uids remembered per header type,
+            and write_concern, see ``_parse_write_concern``. blob_threshold
+            (bytes) and blob_store ('gridfs' or a directory) enable offloading
+            of large data values. compression ('zlib' or 'zstd') and
+            compression_threshold (bytes) enable compression of large data
+            and timestamps values. bucket_size switches data_reference to the bucketed
+            layout, see ``_bucket_insert``. validate enables schema
+            validation of inserted documents, see ``_validate``
         """
         if not testing:
             try:
@@ -29,6 +161,189 @@ class AStore:
 
             self.client = mongomock.MongoClient(config["uri"])
         self.database = self.client[config["database"]]
+        cache_size = config.get('header_cache_size', DEFAULT_UID_CACHE_SIZE)
+        self._known_ahdrs = UidCache(cache_size)
+        self._known_dhdrs = UidCache(cache_size)
+        # first insert_seq of the blocks allocated to inserts in progress
+        self._in_flight = dict()
+        # per collection [next, end) range of insert_seq reserved locally
+        self._seq_blocks = dict()
+        # collections that received unacknowledged sequenced inserts
+        self._unacknowledged = set()
+        self._seq_lock = threading.Lock()
+        self._write_concerns = self._parse_write_concern(
+            config.get('write_concern') or {})
+        self._blob_threshold = config.get('blob_threshold')
+        # the blob store only exists when offloading is enabled
+        self._blobs = None
+        blob_store = config.get('blob_store', 'gridfs')
+        if self._blob_threshold and blob_store == 'gridfs':
+            if testing:
+                import mongomock.gridfs
+                mongomock.gridfs.enable_gridfs_integration()
+            self._blobs = GridFSBlobStore(self.database)
+        elif self._blob_threshold:
+            self._blobs = FileBlobStore(blob_store)
+        self._compression = config.get('compression')
+        if self._compression:
+            check_codec(self._compression)
+        self._compression_threshold = config.get('compression_threshold',
+                                                 DEFAULT_COMPRESSION_THRESHOLD)
+        self._bucket_size = config.get('bucket_size')
+        if (self._bucket_size and
+                self.database.data_reference.find_one({}, {'_id': True})):
+            # reads of the bucketed layout would not see these references
+            raise AnalysisstoreException(
+                'bucket_size is set but data_reference holds documents in the '
+                'plain layout, move them with AStore.migrate_to_buckets first')
+        # compiled once, validating per document would dominate bulk inserts
+        self._validators = None
+        if config.get('validate'):
+            self._validators = compile_validators()
+
+    def _validate(self, doc_type, doc):
+        """Validate a document against the schema of doc_type if validation
+        is enabled
+
+        Raises
+        ------
+        AnalysisstoreException
+            If the document does not match the schema
+        """
+        if self._validators is not None:
+            self._validators[doc_type](doc)
+
+    def _validate_bulk(self, doc_type, docs):
+        """Validate a list of documents in one pass if validation is enabled.
+        Only if the list is invalid, documents are checked one by one to
+        single out the invalid ones.
+
+        Returns
+        -------
+        tuple
+            The valid documents and uid/error pairs of the invalid ones
+        """
+        if self._validators is None:
+            return docs, []
+        try:
+            self._validators['bulk_' + doc_type](docs)
+            return docs, []
+        except AnalysisstoreException:
+            pass
+        valid, failed = [], []
+        for doc in docs:
+            try:
+                self._validators[doc_type](doc)
+                valid.append(doc)
+            except AnalysisstoreException as err:
+                uid = doc.get('uid') if isinstance(doc, dict) else None
+                failed.append(dict(uid=uid, error=str(err)))
+        return valid, failed
+
+    def _parse_write_concern(self, write_concern):
+        """Resolve the configured write concern per collection.
+
+        Parameters
+        ----------
+        write_concern : dict
+            WriteConcern options (``w``, ``j``, ``wtimeout``) applied to all
+            collections. A key named after a collection holds options that
+            override these for that collection only, e.g.
+            ``{'w': 1, 'data_reference': {'w': 0}}``
+
+        Returns
+        -------
+        dict
+            Collection name to pymongo.WriteConcern, or None for the default
+        """
+        defaults = {k: v for k, v in write_concern.items() if k not in INDEXES}
+        resolved = {}
+        for collection in INDEXES:
+            options = dict(defaults, **write_concern.get(collection, {}))
+            resolved[collection] = self._write_concern(options) if options else None
+        return resolved
+
+    def _write_concern(self, options):
+        """Build a WriteConcern, reporting invalid options to the caller"""
+        try:
+            return WriteConcern(**options)
+        except (TypeError, pymongo.errors.ConfigurationError) as err:
+            raise AnalysisstoreException('Invalid write concern {}: {}'.format(options, err))
+
+    def _collection(self, name, write_concern=None):
+        """Return collection ``name`` using the configured write concern, or
+        ``write_concern`` options if given for this request. w=0 makes writes
+        unacknowledged: faster, but failures go unnoticed and ``since`` is
+        no longer available on the collection."""
+        if write_concern is not None:
+            wc = self._write_concern(write_concern)
+        else:
+            wc = self._write_concerns[name]
+        if wc is None:
+            return self.database[name]
+        return self.database[name].with_options(write_concern=wc)
+
+    def ensure_indexes(self):
+        """Create the indexes declared in ``INDEXES`` on every collection.
+
+        Index creation is idempotent. Failures (e.g. duplicate uids already
+        present in a legacy database) are logged instead of raised, so that
+        the service still starts and the problem shows up in
+        ``index_report``.
+
+        Returns
+        -------
+        dict
+            Collection name to list of index names created or confirmed
+        """
+        created = {}
+        for collection, specs in INDEXES.items():
+            created[collection] = []
+            for spec in specs:
+                try:
+                    name = self.database[collection].create_index(
+                        spec['keys'], unique=spec.get('unique', False))
+                except pymongo.errors.OperationFailure as err:
+                    logger.warning("Unable to create index %r on %s: %s",
+                                   spec['keys'], collection, err)
+                    continue
+                created[collection].append(name)
+        return created
+
+    def _index_usage(self, collection):
+        """Return the number of operations served per index name since the
+        mongod started, or None if the backend does not support $indexStats"""
+        try:
+            stats = self.database[collection].aggregate([{'$indexStats': {}}])
+            return {s['name']: s['accesses']['ops'] for s in stats}
+        except (NotImplementedError, pymongo.errors.OperationFailure):
+            return None
+
+    def index_report(self):
+        """Compare the declared indexes against the existing ones.
+
+        Returns
+        -------
+        dict
+            Keyed on collection name. ``missing`` lists the declared key
+            specs that do not exist, ``unused`` lists the existing index
+            names that have served no operation since the mongod started
+            (None if usage statistics are unavailable).
+        """
+        report = {}
+        for collection, specs in INDEXES.items():
+            info = self.database[collection].index_information()
+            existing = [[list(k) for k in v['key']] for v in info.values()]
+            missing = [[list(k) for k in spec['keys']] for spec in specs
+                       if [list(k) for k in spec['keys']] not in existing]
+            usage = self._index_usage(collection)
+            if usage is None:
+                unused = None
+            else:
+                unused = sorted(name for name, ops in usage.items()
+                                if ops == 0 and name != '_id_')
+            report[collection] = dict(missing=missing, unused=unused)
+        return report
 
     def doc_or_uid_to_uid(self, doc_or_uid):
         """Given Document or uid return the uid
@@ -60,8 +375,12 @@ class AStore:
             uid of the header that has been verified
         """
         hdr = self.doc_or_uid_to_uid(analysis_header)
-        if not self.find_analysis_header(uid=hdr):
+        if hdr in self._known_ahdrs:
+            return hdr
+        if self.database.analysis_header.find_one({'uid': hdr},
+                                                  {'_id': True}) is None:
             raise RuntimeError('No Analysis Header found uid {}'.format(hdr))
+        self._known_ahdrs.add(hdr)
         return hdr
 
     def extract_verify_dhdr(self, data_reference_header):
@@ -78,11 +397,21 @@ class AStore:
             uid of the data reference header that has been verified
         """
         hdr = self.doc_or_uid_to_uid(data_reference_header)
-        if not self.find_data_reference_header(uid=hdr):
+        if hdr in self._known_dhdrs:
+            return hdr
+        if self.database.data_reference_header.find_one({'uid': hdr},
+                                                        {'_id': True}) is None:
             raise RuntimeError('No DataReferenceHeader found uid {}'.format(hdr))
+        self._known_dhdrs.add(hdr)
         return hdr
 
-    def insert_analysis_header(self, time, uid, provenance, **kwargs):
+    def cache_stats(self):
+        """Hit/miss counters and sizes of the verified header caches"""
+        return dict(analysis_header=self._known_ahdrs.stats(),
+                    data_reference_header=self._known_dhdrs.stats())
+
+    def insert_analysis_header(self, time, uid, provenance, write_concern=None,
+                               **kwargs):
         """Create a database entry for the analysis_header
         Parameters
         __________
@@ -92,6 +421,8 @@ class AStore:
             Unique identifier for the analysis header document
          provenance : dict
             Provenance information for this data analysis
+         write_concern : dict, optional
+            WriteConcern options overriding the configured ones
 
         Returns
         --------
@@ -99,11 +430,15 @@ class AStore:
             Unique identifier of the document inserted
         """
         doc = dict(time=time, uid=uid, provenance=provenance, **kwargs)
-        self.database.analysis_header.insert_one(doc)
+        self._validate('analysis_header', doc)
+        coll = self._collection('analysis_header', write_concern)
+        with self._sequenced('analysis_header', [doc], coll):
+            coll.insert_one(doc)
+        self._known_ahdrs.add(uid)
         return uid
 
     def insert_data_reference_header(self, time, uid, analysis_header,
-                                     data_keys, **kwargs):
+                                     data_keys, write_concern=None, **kwargs):
         """Create a database entry for the data_reference_header
         Parameters
         __________
@@ -115,6 +450,8 @@ class AStore:
             Foreign key to data analysis header
         data_keys : dict
            Set of key/value pairs that describe the contents of data reference
+        write_concern : dict, optional
+           WriteConcern options overriding the configured ones
 
         Returns
         --------
@@ -128,21 +465,537 @@ class AStore:
         doc = dict(time=time, uid=uid, analysis_header=analysis_header,
                    data_keys=data_keys,
                    **kwargs)
-        self.database.data_reference_header.insert_one(doc)
+        self._validate('data_reference_header', doc)
+        coll = self._collection('data_reference_header', write_concern)
+        with self._sequenced('data_reference_header', [doc], coll):
+            coll.insert_one(doc)
+        self._known_dhdrs.add(uid)
         return uid
 
-    def bulk_data_reference_insert(self, data_header, data_references):
+    def _encode_data_reference(self, doc):
+        """Convert a data_reference document from its wire to its stored
+        representation: binary arrays in ``data`` become BSON binary, values
+        above blob_threshold bytes move to the blob store and data and
+        timestamps values above compression_threshold bytes are compressed
+        one by one, see ``_check_compressed``."""
+        if isinstance(doc.get('data'), dict):
+            arrays_to_binary(doc['data'])
+            if self._blob_threshold:
+                offload_blobs(doc['data'], self._blobs, self._blob_threshold)
+        if self._compression:
+            for field in COMPRESSED_FIELDS:
+                if isinstance(doc.get(field), dict):
+                    compress_values(doc[field], self._compression,
+                                    self._compression_threshold)
+        return doc
+
+    def _check_compressed(self, collection, query, fields=()):
+        """With compression enabled, data and timestamps values above the
+        threshold are stored as an opaque compressed payload, which the
+        database can not look into. Values below it are stored as is, so
+        paths such as ``data.x`` can be queried, projected and aggregated
+        on, but never match a compressed value. Paths reaching below a value,
+        e.g. ``data.img.0``, are refused rather than silently matching
+        nothing.
+
+        Parameters
+        ----------
+        collection : str
+            Name of the collection queried
+        query : dict or list
+            Query in mongo query format or aggregation pipeline
+        fields : list, optional
+            Projected fields or distinct key
+        """
+        if not self._compression or collection != 'data_reference':
+            return
+        paths = list(_compressed_paths(query))
+        paths += [f for f in fields if _is_inside_value(f)]
+        if paths:
+            raise AnalysisstoreException(
+                '{} can not be used with compression enabled, data and '
+                'timestamps values can only be used whole'.format(sorted(paths)))
+
+    def _decode_data_reference(self, doc):
+        """Inverse of ``_encode_data_reference`` for documents read back"""
+        for field in COMPRESSED_FIELDS:
+            if isinstance(doc.get(field), dict):
+                decompress_values(doc[field])
+        if isinstance(doc.get('data'), dict):
+            arrays_to_base64(doc['data'])
+        return doc
+
+    def _update_summary(self, dhdr, docs, write_concern=None):
+        """Fold newly inserted data references of one header into its summary
+        document with a single atomic upsert, so that count, time range and
+        seq_num range never require a scan of the references.
+
+        The insert creating the summary of a header also folds in the
+        references stored before summaries existed, recognizable by their
+        missing insert_seq, with an aggregation over that header."""
+        if not docs:
+            return
+        low, high = {}, {}
+        for field in ('time', 'seq_num'):
+            values = [d[field] for d in docs if d.get(field) is not None]
+            if values:
+                low[field + '_min'], high[field + '_max'] = min(values), max(values)
+        res = self._fold_summary(dhdr, len(docs), low, high, write_concern,
+                                 upsert=True)
+        if res.acknowledged and res.upserted_id is not None:
+            legacy = self._summarize(dhdr, insert_seq={'$exists': False})
+            if legacy['count']:
+                self._fold_summary(
+                    dhdr, legacy['count'],
+                    {k: v for k, v in legacy.items() if k.endswith('_min')},
+                    {k: v for k, v in legacy.items() if k.endswith('_max')},
+                    write_concern)
+
+    def _fold_summary(self, dhdr, count, low, high, write_concern=None,
+                      upsert=False):
+        """Add count references with the given lower and upper bounds to the
+        summary of dhdr"""
+        update = {'$inc': {'count': count}}
+        if low:
+            update.update({'$min': low, '$max': high})
+        return self._collection('data_reference_summary', write_concern).update_one(
+            {'data_reference_header': dhdr}, update, upsert=upsert)
+
+    def _summarize(self, dhdr, **query):
+        """Summary of the data references of dhdr matching query, computed
+        with an aggregation over the references"""
+        query['data_reference_header'] = dhdr
+        group = {'$group': {'_id': None, 'count': {'$sum': 1},
+                            'time_min': {'$min': '$time'},
+                            'time_max': {'$max': '$time'},
+                            'seq_num_min': {'$min': '$seq_num'},
+                            'seq_num_max': {'$max': '$seq_num'}}}
+        if self._bucket_size:
+            res = self.database.data_reference_bucket.aggregate(
+                self._unpack_buckets(query) + [group])
+        else:
+            res = self.database.data_reference.aggregate([{'$match': query},
+                                                          group])
+        summary = dict(data_reference_header=dhdr, count=0)
+        for doc in res:
+            summary.update((k, v) for k, v in doc.items()
+                           if k != '_id' and v is not None)
+        return summary
+
+    def get_data_reference_summary(self, data_reference_header):
+        """Number of data references, their time range and seq_num range
+        (if the references carry seq_num) for a data reference header, read
+        from a summary maintained on insert. Headers whose references were
+        all stored before summaries existed are aggregated instead
+
+        Parameters
+        ----------
+        data_reference_header : doct.Document or str
+            DataReferenceHeader document or uid
+
+        Returns
+        -------
+        dict
+            count, time_min, time_max and optionally seq_num_min and
+            seq_num_max. Only count (0) if nothing was inserted
+        """
+        dhdr = self.doc_or_uid_to_uid(data_reference_header)
+        summary = self.database.data_reference_summary.find_one(
+            {'data_reference_header': dhdr}, {'_id': False})
+        # references stored before summaries existed and none since
+        return summary or self._summarize(dhdr)
+
+    def _bucket_insert(self, dhdr, docs, write_concern=None):
+        """Append data references of one header to bucket documents in the
+        data_reference_bucket collection, in the spirit of Mongo time series
+        collections. A bucket holds up to bucket_size entries plus the count
+        and time range of its entries, so a scan costs one document and one
+        index entry per bucket rather than per reference. Chunks go to the
+        open bucket of the header if they fit, else to a new bucket.
+
+        Documents above MAX_BSON_SIZE and uids repeated within docs or
+        already stored in a bucket are reported in ``failed``. The uid check
+        is not atomic, two concurrent inserts of the same uid can both
+        succeed. bucket_size must keep buckets below the 16MB document limit.
+
+        Returns
+        -------
+        dict
+            ``inserted`` uids and ``failed`` uid/error pairs
+        """
+        accepted, failed, seen = [], [], set()
+        for doc in docs:
+            nbytes = len(bson.encode(doc))
+            if nbytes > MAX_BSON_SIZE:
+                failed.append(dict(uid=doc.get('uid'),
+                                   error='Document too large: {} bytes'.format(nbytes)))
+            elif doc['uid'] in seen:
+                failed.append(dict(uid=doc['uid'], error='Duplicate uid'))
+            else:
+                seen.add(doc['uid'])
+                accepted.append(doc)
+        if accepted:
+            stored = seen.intersection(self.database.data_reference_bucket.distinct(
+                'entries.uid', {'entries.uid': {'$in': list(seen)}}))
+            failed.extend(dict(uid=d['uid'], error='Duplicate uid')
+                          for d in accepted if d['uid'] in stored)
+            accepted = [d for d in accepted if d['uid'] not in stored]
+        coll = self._collection('data_reference_bucket', write_concern)
+        with self._sequenced('data_reference', accepted, coll):
+            self._fill_buckets(coll, dhdr, accepted, self._bucket_size)
+        return dict(inserted=[d['uid'] for d in accepted], failed=failed)
+
+    def _fill_buckets(self, coll, dhdr, docs, bucket_size):
+        """Push docs into the buckets of header dhdr, bucket_size at a time"""
+        for i in range(0, len(docs), bucket_size):
+            chunk = docs[i:i + bucket_size]
+            update = {'$push': {'entries': {'$each': chunk}},
+                      '$inc': {'count': len(chunk)}}
+            times = [d['time'] for d in chunk if d.get('time') is not None]
+            if times:
+                update.update({'$min': {'time_min': min(times)},
+                               '$max': {'time_max': max(times)}})
+            coll.update_one({'data_reference_header': dhdr,
+                             'count': {'$lte': bucket_size - len(chunk)}},
+                            update, upsert=True)
+
+    def migrate_to_buckets(self, bucket_size):
+        """Move the data references stored in the plain layout into buckets
+        of bucket_size entries, header by header in insertion order, so that
+        a server configured with this bucket_size can start. Run it from an
+        AStore configured without bucket_size while no server writes to the
+        database. References are removed from data_reference once pushed to
+        a bucket, an interrupted migration can be resumed.
+
+        Parameters
+        ----------
+        bucket_size : int
+            Entries per bucket, as configured for the server
+
+        Returns
+        -------
+        int
+            Number of data references moved
+        """
+        if self._bucket_size:
+            raise AnalysisstoreException('migrate_to_buckets requires an '
+                                         'AStore without bucket_size')
+        source = self.database.data_reference
+        coll = self.database.data_reference_bucket
+        moved = 0
+        for dhdr in source.distinct('data_reference_header'):
+            cur = source.find({'data_reference_header': dhdr}).sort(
+                [('insert_seq', ASCENDING), ('time', ASCENDING)])
+            chunk = []
+            for doc in cur:
+                chunk.append(doc)
+                if len(chunk) == bucket_size:
+                    moved += self._move_to_bucket(coll, dhdr, chunk, bucket_size)
+                    chunk = []
+            moved += self._move_to_bucket(coll, dhdr, chunk, bucket_size)
+        return moved
+
+    def _move_to_bucket(self, coll, dhdr, docs, bucket_size):
+        ids = [doc.pop('_id') for doc in docs]
+        # pushed by an interrupted run that did not get to delete them
+        done = set(coll.distinct('entries.uid', {'entries.uid': {
+            '$in': [d['uid'] for d in docs]}}))
+        self._fill_buckets(coll, dhdr, [d for d in docs if d['uid'] not in done],
+                           bucket_size)
+        source = self.database.data_reference
+        return source.delete_many({'_id': {'$in': ids}}).deleted_count
+
+    def _is_bucketed(self, collection):
+        return collection == 'data_reference' and bool(self._bucket_size)
+
+    def _unpack_buckets(self, query, pushdown=None, before=None):
+        """Aggregation stages turning bucket documents back into the data
+        references matching query.
+
+        Parameters
+        ----------
+        query : dict
+            Query on data references, in mongo query format
+        pushdown : dict, optional
+            Query whose data_reference_header, uid and time conditions are
+            used to skip buckets, defaults to query
+        before : float, optional
+            Time of a keyset continuation, buckets whose entries are all
+            later are skipped
+        """
+        pushdown = query if pushdown is None else pushdown
+        bucket_match = {}
+        if before is not None:
+            bucket_match['time_min'] = {'$lte': before}
+        if 'data_reference_header' in pushdown:
+            bucket_match['data_reference_header'] = pushdown['data_reference_header']
+        for field in BUCKET_PUSHDOWN_FIELDS:
+            cond = pushdown.get(field)
+            if cond is None:
+                continue
+            if (not isinstance(cond, dict) or
+                    BUCKET_PUSHDOWN_OPERATORS.issuperset(cond)):
+                bucket_match['entries.' + field] = cond
+        stages = [{'$match': bucket_match}] if bucket_match else []
+        stages += [{'$unwind': '$entries'},
+                   {'$replaceRoot': {'newRoot': '$entries'}}]
+        if query:
+            stages.append({'$match': query})
+        return stages
+
+    @contextmanager
+    def _sequenced(self, collection, docs, coll):
+        """Stamp docs with consecutive insert_seq values for the duration of
+        their insert. Values are handed out from a block of at least
+        SEQ_BLOCK_SIZE reserved with one round trip to a per collection
+        counter, so most inserts do not touch the counter. Values left in a
+        block when the process exits are skipped.
+
+        Sequence numbers are allocated before the write, so an insert may
+        become visible after one holding higher numbers. find_* with
+        ``since`` therefore withholds documents numbered above a block still
+        being inserted by this process. Inserts running in other server
+        processes are not accounted for, nor are unacknowledged writes, which
+        may be applied after the block is released. The latter switch
+        ``since`` off for collection, see ``_check_since``.
+
+        Parameters
+        ----------
+        collection : str
+            Collection whose counter numbers the docs
+        docs : list
+            Documents to stamp
+        coll : pymongo.collection.Collection
+            Collection the docs are written to, with its write concern
+        """
+        if not docs:
+            yield
+            return
+        if not coll.write_concern.acknowledged:
+            with self._seq_lock:
+                self._unacknowledged.add(collection)
+        with self._seq_lock:
+            # allocated and registered at once, so that _visible_seq never
+            # misses an allocated block
+            first = self._allocate_seq(collection, len(docs))
+            self._in_flight.setdefault(collection, set()).add(first)
+        for i, doc in enumerate(docs):
+            doc['insert_seq'] = first + i
+        try:
+            yield
+        finally:
+            with self._seq_lock:
+                self._in_flight[collection].discard(first)
+
+    def _allocate_seq(self, collection, n):
+        """First of n consecutive insert_seq values, reserving a new block
+        from the counter if the local one is exhausted. Requires _seq_lock"""
+        block = self._seq_blocks.get(collection)
+        if block is None or block[1] - block[0] < n:
+            size = max(n, SEQ_BLOCK_SIZE)
+            counter = self.database.counters.find_one_and_update(
+                {'_id': collection}, {'$inc': {'seq': size}}, upsert=True,
+                return_document=ReturnDocument.AFTER)
+            block = [counter['seq'] - size + 1, counter['seq'] + 1]
+            self._seq_blocks[collection] = block
+        first = block[0]
+        block[0] += n
+        return first
+
+    def _check_since(self, collection):
+        """Refuse ``since`` on a collection written with an unacknowledged
+        write concern, configured or requested by an earlier insert. Such a
+        write may be applied after later ones were returned, and a poll would
+        then skip it for good."""
+        name = collection
+        if self._is_bucketed(collection):
+            name = 'data_reference_bucket'
+        wc = self._write_concerns.get(name)
+        with self._seq_lock:
+            unacknowledged = collection in self._unacknowledged
+        if unacknowledged or (wc is not None and not wc.acknowledged):
+            raise AnalysisstoreException(
+                'since is not available on {}, it is written with an '
+                'unacknowledged write concern'.format(collection))
+
+    def _visible_seq(self, collection):
+        """Lowest insert_seq of an insert in progress, None if there is none"""
+        with self._seq_lock:
+            return min(self._in_flight.get(collection) or [None])
+
+    def _batches(self, docs, failed):
+        """Split docs into batches bounded by BULK_BATCH_COUNT documents and
+        BULK_BATCH_BYTES encoded bytes. Documents above MAX_BSON_SIZE are
+        reported in ``failed`` instead of failing their whole batch."""
+        batch, size = [], 0
+        for doc in docs:
+            nbytes = len(bson.encode(doc))
+            if nbytes > MAX_BSON_SIZE:
+                failed.append(dict(uid=doc.get('uid'),
+                                   error='Document too large: {} bytes'.format(nbytes)))
+                continue
+            if batch and (len(batch) >= BULK_BATCH_COUNT or
+                          size + nbytes > BULK_BATCH_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(doc)
+            size += nbytes
+        if batch:
+            yield batch
+
+    def _bulk_insert(self, collection, docs, write_concern=None):
+        """Insert docs in size bounded, unordered batches. With unacknowledged
+        writes (w=0) every submitted document is reported as inserted.
+
+        Returns
+        -------
+        dict
+            ``inserted`` lists the uids written, ``failed`` lists uid/error
+            pairs (e.g. duplicate keys) so that only those need a retry
+        """
+        inserted, failed = [], []
+        coll = self._collection(collection, write_concern)
+        with self._sequenced(collection, docs, coll):
+            for batch in self._batches(docs, failed):
+                try:
+                    coll.insert_many(batch, ordered=False)
+                    inserted.extend(d['uid'] for d in batch)
+                except pymongo.errors.BulkWriteError as err:
+                    errors = {e['index']: e['errmsg']
+                              for e in err.details['writeErrors']}
+                    for i, doc in enumerate(batch):
+                        if i in errors:
+                            failed.append(dict(uid=doc.get('uid'),
+                                               error=errors[i]))
+                        else:
+                            inserted.append(doc['uid'])
+        return dict(inserted=inserted, failed=failed)
+
+    def bulk_analysis_header_insert(self, analysis_headers, write_concern=None):
+        """Insert many analysis_header documents in a single call
+
+        Parameters
+        ----------
+        analysis_headers : list
+            analysis_header documents, each with time, uid and provenance
+
+        write_concern : dict, optional
+            WriteConcern options overriding the configured ones
+
+        Returns
+        -------
+        dict
+            ``inserted`` uids and ``failed`` uid/error pairs
+        """
+        analysis_headers, invalid = self._validate_bulk('analysis_header',
+                                                        analysis_headers)
+        res = self._bulk_insert('analysis_header', analysis_headers,
+                                write_concern)
+        for uid in res['inserted']:
+            self._known_ahdrs.add(uid)
+        res['failed'] = invalid + res['failed']
+        return res
+
+    def bulk_data_reference_header_insert(self, data_reference_headers,
+                                          write_concern=None):
+        """Insert many data_reference_header documents in a single call
+
+        Parameters
+        ----------
+        data_reference_headers : list
+            data_reference_header documents, each with time, uid,
+            analysis_header and data_keys
+
+        write_concern : dict, optional
+            WriteConcern options overriding the configured ones
+
+        Returns
+        -------
+        dict
+            ``inserted`` uids and ``failed`` uid/error pairs
+        """
+        for d in data_reference_headers:
+            d['analysis_header'] = self.doc_or_uid_to_uid(d['analysis_header'])
+        data_reference_headers, invalid = self._validate_bulk(
+            'data_reference_header', data_reference_headers)
+        res = self._bulk_insert('data_reference_header', data_reference_headers,
+                                write_concern)
+        for uid in res['inserted']:
+            self._known_dhdrs.add(uid)
+        res['failed'] = invalid + res['failed']
+        return res
+
+    def bulk_analysis_tail_insert(self, analysis_tails, write_concern=None):
+        """Insert many analysis_tail documents in a single call
+
+        Parameters
+        ----------
+        analysis_tails : list
+            analysis_tail documents, each with time, uid, analysis_header and
+            exit_status
+
+        write_concern : dict, optional
+            WriteConcern options overriding the configured ones
+
+        Returns
+        -------
+        dict
+            ``inserted`` uids and ``failed`` uid/error pairs
+        """
+        for d in analysis_tails:
+            d['analysis_header'] = self.doc_or_uid_to_uid(d['analysis_header'])
+        analysis_tails, invalid = self._validate_bulk('analysis_tail',
+                                                      analysis_tails)
+        res = self._bulk_insert('analysis_tail', analysis_tails, write_concern)
+        res['failed'] = invalid + res['failed']
+        return res
+
+    def bulk_data_reference_insert(self, data_header, data_references,
+                                   write_concern=None):
+        """Insert many data_reference documents under one data reference header
+
+        Parameters
+        ----------
+        data_header : doct.Document or uid
+            data_reference_header the data references point to
+        data_references : list
+            data_reference documents
+
+        write_concern : dict, optional
+            WriteConcern options overriding the configured ones
+
+        Returns
+        -------
+        dict
+            ``inserted`` uids and ``failed`` uid/error pairs
+        """
         try:
             dhdr = self.extract_verify_dhdr(data_header)
         except RuntimeError:
             dhdr = self.doc_or_uid_to_uid(data_header)
-        res = self.database.data_reference.insert_many(data_references,
-                                                       ordered=False)
-        print('inserted the bulk')
-        return True
+        for d in data_references:
+            d['data_reference_header'] = dhdr
+        data_references, invalid = self._validate_bulk('data_reference',
+                                                       data_references)
+        for d in data_references:
+            self._encode_data_reference(d)
+        if self._bucket_size:
+            res = self._bucket_insert(dhdr, data_references, write_concern)
+        else:
+            res = self._bulk_insert('data_reference', data_references,
+                                    write_concern)
+        # a uid repeated in the request is inserted at most once
+        inserted, done = set(res['inserted']), []
+        for d in data_references:
+            if d['uid'] in inserted:
+                inserted.discard(d['uid'])
+                done.append(d)
+        self._update_summary(dhdr, done, write_concern)
+        res['failed'] = invalid + res['failed']
+        return res
 
     def insert_data_reference(self, time, uid, data_reference_header,
-                              data, timestamps, **kwargs):
+                              data, timestamps, write_concern=None, **kwargs):
         """
         Create data reference header document
         Parameters
@@ -154,6 +1007,8 @@ class AStore:
             Unique identifier for data_reference document
         time : float
             Time document was created. Server fills up this field if not provided
+        write_concern : dict, optional
+            WriteConcern options overriding the configured ones
         kwargs : dict
             Additional fields
 
@@ -168,11 +1023,22 @@ class AStore:
             dhdr = self.doc_or_uid_to_uid(data_reference_header)
         doc = dict(time=time, uid=uid, data_reference_header=dhdr,
                    data=data, timestamps=timestamps, **kwargs)
-        self.database.data_reference.insert_one(doc)
+        self._validate('data_reference', doc)
+        self._encode_data_reference(doc)
+        if self._bucket_size:
+            failed = self._bucket_insert(dhdr, [doc], write_concern)['failed']
+            if failed:
+                raise AnalysisstoreException('{}: {}'.format(uid,
+                                                             failed[0]['error']))
+        else:
+            coll = self._collection('data_reference', write_concern)
+            with self._sequenced('data_reference', [doc], coll):
+                coll.insert_one(doc)
+        self._update_summary(dhdr, [doc], write_concern)
         return uid
 
     def insert_analysis_tail(self, time, uid, analysis_header, exit_status,
-                             **kwargs):
+                             write_concern=None, **kwargs):
         """Create a database entry for the analysis_tail
 
         Parameters
@@ -183,6 +1049,8 @@ class AStore:
             Unique identifier for the analysis tail document
          analysis_header: doct.Document or uid
             Foreign key to data analysis tail
+         write_concern: dict, optional
+            WriteConcern options overriding the configured ones
 
         Returns
         --------
@@ -196,44 +1064,397 @@ class AStore:
             hdr = self.doc_or_uid_to_uid(analysis_header)
         doc = dict(time=time, uid=uid, analysis_header=analysis_header,
                    exit_status=exit_status, **kwargs)
-        self.database.analysis_tail.insert_one(doc)
+        self._validate('analysis_tail', doc)
+        coll = self._collection('analysis_tail', write_concern)
+        with self._sequenced('analysis_tail', [doc], coll):
+            coll.insert_one(doc)
         return uid
 
-    def _clean_ids(self, cursor):
-        # TODO: Replace this with mongo aggregation pipeline
-        """Given a pymongo cursor, all _id fields are removed from set of documents"""
-        res = []
-        for c in cursor:
-            del c['_id']
-            res.append(c)
-        return res
+    def _projection(self, fields=None):
+        """Build the projection for a find_* query. _id is always excluded on
+        the server side. If ``fields`` is given (dotted paths allowed) only
+        those plus time and uid, which keep the sort and paging keys, are
+        returned."""
+        projection = {'_id': False}
+        if fields is not None:
+            if isinstance(fields, six.string_types):
+                fields = [fields]
+            projection.update({f: True for f in fields})
+            projection.update(time=True, uid=True)
+        return projection
+
+    def _iter_clean_ids(self, cursor, transform=None):
+        """Lazily yield the documents of a pymongo cursor projected without
+        _id fields, closing the cursor once done. ``transform`` is applied
+        to every document if given"""
+        try:
+            for c in cursor:
+                yield c if transform is None else transform(c)
+        finally:
+            cursor.close()
+
+    def _clean_ids(self, cursor, transform=None):
+        """Given a pymongo cursor projected without _id fields, return the set
+        of documents as a list"""
+        return list(self._iter_clean_ids(cursor, transform))
+
+    def _find(self, collection, fields=None, limit=None, next=None, lazy=False,
+              since=None, **query):
+        """Run a query against a collection sorted on (time, uid) DESCENDING.
+
+        Parameters
+        ----------
+        collection : str
+            Name of the collection to query
+        fields : list, optional
+            Fields to return, dotted paths such as ``data.diffr1`` allowed.
+            time and uid are always included. All fields if not provided
+        limit : int, optional
+            Page size. If provided, a single page is returned together with
+            the token for the following page
+        next : str, optional
+            Opaque token returned with the previous page
+        lazy : bool, optional
+            If True and no ``limit`` is given, return a generator iterating
+            the cursor instead of a list
+        since : int, optional
+            Cursor returned by the previous poll, 0 for the first one. Only
+            documents inserted after it are returned, oldest first. Documents
+            stored before insert_seq existed carry none and are never
+            returned, not even for 0. Refused on collections written with an
+            unacknowledged write concern
+        query : dict
+            Query in mongo query format
+
+        Returns
+        -------
+        list, generator or dict
+            List (generator if ``lazy``) of documents if no ``limit`` is
+            given, otherwise a dict with the page under ``data`` and the
+            ``next`` token (None on the last page). With ``since``, a dict
+            with the (at most ``limit``) new documents under ``data`` and the
+            cursor for the following poll under ``since``
+        """
+        if limit is None and next is not None:
+            raise AnalysisstoreException('next token requires a limit')
+        spec = self._find_command(collection, fields, limit, next, query,
+                                  since)
+        if 'pipeline' in spec:
+            cur = self.database[spec['aggregate']].aggregate(spec['pipeline'])
+        else:
+            cur = self.database[collection].find(spec['filter'],
+                                                 spec['projection'])
+            cur = cur.sort(list(spec['sort'].items()))
+            if limit is not None:
+                cur = cur.limit(limit)
+        transform = None
+        if collection == 'data_reference':
+            transform = self._decode_data_reference
+        if since is not None:
+            docs = self._clean_ids(cur, transform)
+            if docs:
+                since = docs[-1]['insert_seq']
+            return dict(data=docs, since=since)
+        if limit is None:
+            if lazy:
+                return self._iter_clean_ids(cur, transform)
+            return self._clean_ids(cur, transform)
+        docs = self._clean_ids(cur, transform)
+        token = None
+        if len(docs) == limit:
+            token = encode_page_token(docs[-1]['time'], docs[-1]['uid'])
+        return dict(data=docs, next=token)
+
+    def _find_command(self, collection, fields, limit, next, query,
+                      since=None):
+        """Validate the find options of _find and translate them into the
+        find (or, for the bucketed layout, aggregate) database command"""
+        if isinstance(fields, six.string_types):
+            fields = [fields]
+        self._check_compressed(collection, query, fields or ())
+        sort = {'time': DESCENDING, 'uid': DESCENDING}
+        if since is not None:
+            if next is not None:
+                raise AnalysisstoreException('since and next are exclusive')
+            if not isinstance(since, int) or since < 0:
+                raise AnalysisstoreException('since must be a non negative '
+                                             'integer')
+            self._check_since(collection)
+            newer = {'$gt': since}
+            visible = self._visible_seq(collection)
+            if visible is not None:
+                newer['$lt'] = visible
+            if 'insert_seq' in query:
+                query = {'$and': [query, {'insert_seq': newer}]}
+            else:
+                query = dict(query, insert_seq=newer)
+            sort = {'insert_seq': ASCENDING}
+            if fields is not None:
+                fields = list(fields) + ['insert_seq']
+        pushdown, before = query, None
+        if next is not None:
+            time, uid = decode_page_token(next)
+            before = time
+            # keyset continuation on the (time, uid) DESCENDING sort
+            after = {'$or': [{'time': {'$lt': time}},
+                             {'time': time, 'uid': {'$lt': uid}}]}
+            query = {'$and': [query, after]} if query else after
+        if limit is not None and (not isinstance(limit, int) or limit <= 0):
+            raise AnalysisstoreException('limit must be a positive integer')
+        if self._is_bucketed(collection):
+            pipeline = self._unpack_buckets(query, pushdown, before)
+            pipeline.append({'$sort': sort})
+            if limit is not None:
+                pipeline.append({'$limit': limit})
+            pipeline.append({'$project': self._projection(fields)})
+            return dict(aggregate='data_reference_bucket', pipeline=pipeline,
+                        cursor={})
+        command = dict(find=collection, filter=query,
+                       projection=self._projection(fields), sort=sort)
+        if limit is not None:
+            command['limit'] = limit
+        return command
+
+    def explain(self, signature, payload):
+        """Return the query planner output of the database for a find_*
+        query, to spot collection scans and in-memory sorts
+
+        Parameters
+        ----------
+        signature : str
+            find_<collection> signature of the query
+        payload : dict
+            Query payload as sent to the find_* queryable, including find
+            options such as ``limit``, ``next`` and ``fields``
+
+        Returns
+        -------
+        dict
+            Output of the explain command
+        """
+        collection = signature[len('find_'):]
+        if not signature.startswith('find_') or collection not in (
+                'analysis_header', 'analysis_tail', 'data_reference_header',
+                'data_reference'):
+            raise AnalysisstoreException('Can not explain {}'.format(signature))
+        query = dict(payload)
+        options = [query.pop(k, None) for k in ('fields', 'limit', 'next')]
+        since = query.pop('since', None)
+        query.pop('lazy', None)
+        command = self._find_command(collection, *options, query=query,
+                                     since=since)
+        try:
+            res = self.database.command(dict(explain=command,
+                                             verbosity='queryPlanner'))
+        except (NotImplementedError, pymongo.errors.OperationFailure) as err:
+            raise AnalysisstoreException('explain failed: {}'.format(err))
+        return json.loads(json_util.dumps(res))
 
     def find_analysis_header(self,  **kwargs):
-        """Given a set of parameters, return analysis header(s) that match the provided criteria"""
-        cur = self.database.analysis_header.find(kwargs).sort([('time', DESCENDING),
-                                                               ('uid', DESCENDING)])
-        return self._clean_ids(cur)
+        """Given a set of parameters, return analysis header(s) that match the
+        provided criteria. Pass ``limit`` (and ``next``) for a single page and
+        ``fields`` for a projection.
+        """
+        return self._find('analysis_header', **kwargs)
 
     def find_data_reference_header(self, **kwargs):
         """Given a set of kwargs in mongo query format, returns a list of data
-        reference headers that matches given criteria
+        reference headers that matches given criteria. Pass ``limit`` (and
+        ``next``) for a single page and ``fields`` for a projection.
         """
-        cur = self.database.data_reference_header.find(kwargs).sort([('time', DESCENDING),
-                                                                     ('uid', DESCENDING)])
-        return self._clean_ids(cur)
+        return self._find('data_reference_header', **kwargs)
 
     def find_data_reference(self, **kwargs):
         """Given a set of kwargs in mongo query format, returns a list of data
-        reference that matches given criteria
+        reference that matches given criteria. Pass ``limit`` (and ``next``)
+        for a single page and ``fields`` for a projection.
         """
-        cur = self.database.data_reference.find(kwargs).sort([('time', DESCENDING),
-                                                                ('uid', DESCENDING)])
-        return self._clean_ids(cur)
+        return self._find('data_reference', **kwargs)
 
     def find_analysis_tail(self, **kwargs):
         """Given a set of kwargs in mongo query format, returns a list of data
-        reference that matches given criteria
+        reference that matches given criteria. Pass ``limit`` (and ``next``)
+        for a single page and ``fields`` for a projection.
+        """
+        return self._find('analysis_tail', **kwargs)
+
+    def get_analysis_tree(self, uid, include_references=False):
+        """Return an analysis header together with everything hanging off it,
+        so that a client can render an analysis with one request. Children
+        are fetched with one $in query per collection on the indexed foreign
+        keys rather than $lookup, which keeps the bucketed data_reference
+        layout and payload decoding transparent.
+
+        Parameters
+        ----------
+        uid : str
+            uid of the analysis header
+        include_references : bool or int, optional
+            If True, include all data references of each data reference
+            header. If a positive integer, include at most that many (most
+            recent first) per data reference header. Not included by default
+
+        Returns
+        -------
+        dict
+            ``analysis_header``, ``analysis_tails`` and
+            ``data_reference_headers``, plus ``data_references`` keyed on
+            data reference header uid if requested
+        """
+        if (include_references is not True and include_references is not False
+                and (not isinstance(include_references, int)
+                     or include_references <= 0)):
+            raise AnalysisstoreException('include_references must be a bool '
+                                         'or a positive integer')
+        hdr = self.database.analysis_header.find_one({'uid': uid},
+                                                     self._projection(None))
+        if hdr is None:
+            raise AnalysisstoreException('No Analysis Header found uid '
+                                         '{}'.format(uid))
+        tree = dict(analysis_header=hdr,
+                    analysis_tails=self._find('analysis_tail',
+                                              analysis_header=uid),
+                    data_reference_headers=self._find('data_reference_header',
+                                                      analysis_header=uid))
+        if include_references is False:
+            return tree
+        dhdrs = [d['uid'] for d in tree['data_reference_headers']]
+        refs = {dhdr: [] for dhdr in dhdrs}
+        if include_references is True:
+            for doc in self._find('data_reference', lazy=True,
+                                  data_reference_header={'$in': dhdrs}):
+                refs[doc['data_reference_header']].append(doc)
+        else:
+            for dhdr in dhdrs:
+                refs[dhdr] = self._find('data_reference',
+                                        limit=include_references,
+                                        data_reference_header=dhdr)['data']
+        tree['data_references'] = refs
+        return tree
+
+    def get_data_reference_blob(self, key):
+        """Resolve a data value offloaded to the blob store. find_data_reference
+        returns ``{'__blob__': key, 'size': nbytes}`` in place of such values,
+        so payloads are only read when a caller asks for them.
+
+        Parameters
+        ----------
+        key : str
+            Blob key found in the data_reference document
+
+        Returns
+        -------
+        dict
+            The original data value under ``value``
+        """
+        if self._blobs is None:
+            raise AnalysisstoreException('Blob offloading is not enabled')
+        return dict(value=load_blob(self._blobs, key))
+
+    def _count(self, collection, **query):
+        """Number of documents in collection matching query"""
+        self._check_compressed(collection, query)
+        if self._is_bucketed(collection):
+            pipeline = self._unpack_buckets(query) + [{'$count': 'n'}]
+            res = list(self.database.data_reference_bucket.aggregate(pipeline))
+            return res[0]['n'] if res else 0
+        return self.database[collection].count_documents(query)
+
+    def _distinct(self, collection, key, **query):
+        """Distinct values of key among documents matching query"""
+        self._check_compressed(collection, [query, {key: None}])
+        if self._is_bucketed(collection):
+            pipeline = self._unpack_buckets(query) + [
+                {'$match': {key: {'$exists': True}}},
+                {'$group': {'_id': '$' + key}}]
+            return [d['_id'] for d in
+                    self.database.data_reference_bucket.aggregate(pipeline)]
+        return self.database[collection].distinct(key, query)
+
+    def count_analysis_header(self, **kwargs):
+        """Given a set of kwargs in mongo query format, returns the number of
+        analysis headers that match"""
+        return self._count('analysis_header', **kwargs)
+
+    def count_data_reference_header(self, **kwargs):
+        """Given a set of kwargs in mongo query format, returns the number of
+        data reference headers that match"""
+        return self._count('data_reference_header', **kwargs)
+
+    def count_data_reference(self, **kwargs):
+        """Given a set of kwargs in mongo query format, returns the number of
+        data references that match"""
+        return self._count('data_reference', **kwargs)
+
+    def count_analysis_tail(self, **kwargs):
+        """Given a set of kwargs in mongo query format, returns the number of
+        analysis tails that match"""
+        return self._count('analysis_tail', **kwargs)
+
+    def distinct_analysis_header(self, key, **kwargs):
+        """Returns the distinct values of key (dotted paths allowed) among the
+        analysis headers matching the kwargs in mongo query format"""
+        return self._distinct('analysis_header', key, **kwargs)
+
+    def distinct_data_reference_header(self, key, **kwargs):
+        """Returns the distinct values of key (dotted paths allowed) among the
+        data reference headers matching the kwargs in mongo query format"""
+        return self._distinct('data_reference_header', key, **kwargs)
+
+    def distinct_data_reference(self, key, **kwargs):
+        """Returns the distinct values of key (dotted paths allowed) among the
+        data references matching the kwargs in mongo query format"""
+        return self._distinct('data_reference', key, **kwargs)
+
+    def distinct_analysis_tail(self, key, **kwargs):
+        """Returns the distinct values of key (dotted paths allowed) among the
+        analysis tails matching the kwargs in mongo query format"""
+        return self._distinct('analysis_tail', key, **kwargs)
+
+    def _check_pipeline(self, pipeline):
+        """Verify that a client supplied aggregation pipeline only uses the
+        stages in AGGREGATION_STAGES and none of FORBIDDEN_OPERATORS"""
+        if not isinstance(pipeline, list):
+            raise AnalysisstoreException('pipeline must be a list of stages')
+        for stage in pipeline:
+            if not isinstance(stage, dict) or len(stage) != 1:
+                raise AnalysisstoreException('Invalid pipeline stage {}'.format(stage))
+            name, = stage
+            if name not in AGGREGATION_STAGES:
+                raise AnalysisstoreException('Pipeline stage {} is not allowed'.format(name))
+        stack = list(pipeline)
+        while stack:
+            item = stack.pop()
+            if isinstance(item, dict):
+                forbidden = FORBIDDEN_OPERATORS.intersection(item)
+                if forbidden:
+                    raise AnalysisstoreException('Operator(s) {} not allowed'.format(sorted(forbidden)))
+                stack.extend(item.values())
+            elif isinstance(item, list):
+                stack.extend(item)
+
+    def aggregate_data_reference(self, pipeline):
+        """Run an aggregation pipeline over the data_reference collection so
+        that only the reduced result leaves the database, e.g. min/max/mean
+        of ``data`` keys grouped by header or bucketed on time.
+
+        Parameters
+        ----------
+        pipeline : list
+            Stages limited to $match, $group, $bucket, $sort and $limit
+
+        Returns
+        -------
+        list
+            Result documents of the pipeline
         """
-        cur = self.database.analysis_tail.find(kwargs).sort([('time', DESCENDING),
-                                                               ('uid', DESCENDING)])
-        return self._clean_ids(cur)
+        self._check_pipeline(pipeline)
+        self._check_compressed('data_reference', pipeline)
+        if self._bucket_size:
+            # a leading $match of the client skips buckets like find_* does
+            pushdown = {}
+            if pipeline and '$match' in pipeline[0]:
+                pushdown = pipeline[0]['$match']
+            pipeline = self._unpack_buckets({}, pushdown) + pipeline
+            return list(self.database.data_reference_bucket.aggregate(pipeline))
+        return list(self.database.data_reference.aggregate(pipeline))
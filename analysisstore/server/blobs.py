@@ -0,0 +1,82 @@
+"""Content addressed stores for data_reference payloads too large to be kept
+inline in the data_reference collection"""
+import hashlib
+import os
+import tempfile
+import gridfs
+from .utils import AnalysisstoreException
+
+
+def content_key(content):
+    """Address of a blob: sha256 hex digest of its bytes"""
+    return hashlib.sha256(content).hexdigest()
+
+
+class GridFSBlobStore:
+    """Blobs kept in a GridFS bucket of the analysisstore database
+
+    Parameters
+    ----------
+    database : pymongo.database.Database
+        Database holding the bucket
+    collection : str
+        Name of the GridFS bucket
+    """
+    def __init__(self, database, collection='data_reference_blobs'):
+        self._fs = gridfs.GridFS(database, collection=collection)
+
+    def put(self, content):
+        """Store content unless already present and return its key"""
+        key = content_key(content)
+        if not self._fs.exists(key):
+            try:
+                self._fs.put(content, _id=key)
+            except gridfs.errors.FileExists:
+                # written concurrently, content is identical
+                pass
+        return key
+
+    def get(self, key):
+        try:
+            return self._fs.get(key).read()
+        except gridfs.errors.NoFile:
+            raise AnalysisstoreException('No blob found with key {}'.format(key))
+
+
+class FileBlobStore:
+    """Blobs kept as files on a local or shared file system, fanned out in
+    sub directories named after the first two characters of their key
+
+    Parameters
+    ----------
+    root : str
+        Directory the blobs are written to, created if missing
+    """
+    def __init__(self, root):
+        self.root = os.path.expanduser(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def put(self, content):
+        """Store content unless already present and return its key"""
+        key = content_key(content)
+        path = self._path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write then rename so readers never see a partial blob
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp, path)
+        return key
+
+    def get(self, key):
+        if len(key) < 3 or not all(c in '0123456789abcdef' for c in key):
+            raise AnalysisstoreException('Invalid blob key {}'.format(key))
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise AnalysisstoreException('No blob found with key {}'.format(key))
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import json
+import threading
+
+# Entries of a UidCache (verified headers, parents of headers) unless
+# configured
+DEFAULT_UID_CACHE_SIZE = 10000
+
+
+class UidCache:
+    """Bounded, thread safe LRU set of uids with hit/miss counters, each uid
+    optionally mapped to a value.
+
+    Used to remember headers that are known to exist, or facts about them
+    such as their parent. Headers are immutable once inserted, so an entry
+    never goes stale and only needs evicting for memory reasons.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of uids kept. 0 disables the cache
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._uids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, uid):
+        with self._lock:
+            if uid in self._uids:
+                self._uids.move_to_end(uid)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __len__(self):
+        return len(self._uids)
+
+    def get(self, uid, default=None):
+        """Value recorded with uid, default if uid is not known"""
+        with self._lock:
+            if uid in self._uids:
+                self._uids.move_to_end(uid)
+                self.hits += 1
+                return self._uids[uid]
+            self.misses += 1
+            return default
+
+    def add(self, uid, value=None):
+        """Record uid as known, with an optional value, evicting the least
+        recently used entry if the cache is full"""
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._uids[uid] = value
+            self._uids.move_to_end(uid)
+            while len(self._uids) > self.maxsize:
+                self._uids.popitem(last=False)
+
+    def stats(self):
+        """Return hits, misses, current size and maxsize as a dict"""
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self._uids), maxsize=self.maxsize)
+
+
+class ResponseCache:
+    """Bounded, thread safe LRU of serialized query responses.
+
+    Entries are keyed on the signature, the canonical payload and the
+    generation of every collection the response was read from. Inserts bump
+    the generation of the collections they write to, so a response is never
+    served once its data changed; stale entries are simply never hit again
+    and age out of the LRU.
+
+    Generations live in this process only. With several server workers an
+    insert handled by one worker is invisible to the caches of the others.
+
+    Parameters
+    ----------
+    maxbytes : int
+        Maximum total size of cached responses in bytes
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._generations = dict()
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, signature, payload, collections):
+        """Build the key of a query. Must be taken before the query runs so
+        that a response racing an insert is stored under the old generation
+
+        Parameters
+        ----------
+        signature : str
+            Signature of the queryable
+        payload : dict
+            Query payload, canonicalized as sorted json
+        collections : iterable of str
+            Collections the response is read from
+        """
+        with self._lock:
+            generations = tuple(self._generations.get(c, 0)
+                                for c in collections)
+        return (signature, json.dumps(payload, sort_keys=True), generations)
+
+    def get(self, key):
+        """Return the cached response for key, or None"""
+        with self._lock:
+            body = self._responses.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._responses.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body):
+        """Cache a serialized response, evicting least recently used
+        responses until the cache fits in maxbytes"""
+        size = len(body)
+        if size > self.maxbytes:
+            return
+        with self._lock:
+            if key in self._responses:
+                return
+            self._responses[key] = body
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                _, evicted = self._responses.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def bump(self, *collections):
+        """Invalidate every cached response read from collections"""
+        with self._lock:
+            for c in collections:
+                self._generations[c] = self._generations.get(c, 0) + 1
+
+    def stats(self):
+        """Return hits, misses, entries, bytes and maxbytes as a dict"""
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self._responses), nbytes=self.nbytes,
+                    maxbytes=self.maxbytes)
@@ -1,23 +1,75 @@
 from __future__ import (absolute_import, print_function)
 from tornado import gen
+from tornado.escape import utf8
 import tornado.ioloop
 import tornado.web
+import tornado.websocket
 import pymongo
 import os
 import ujson
 import json
-from .utils import unpack_params
+import logging
+import time
+from .utils import (unpack_params, return2client, query_shape,
+                    AnalysisstoreException)
+from .subscriptions import SUBSCRIPTION_KEYS
 import doct
 import types
 
+logger = logging.getLogger(__name__)
+
+# Storage calls taking longer than this many milliseconds are logged as slow
+DEFAULT_SLOW_QUERY_MS = 100
+
+# Bounds in seconds of long-polling queries such as wait_analysis_tail. The
+# recheck interval covers inserts handled by other server processes, and only
+# applies when running several workers
+DEFAULT_WAIT_TIMEOUT = 30
+MAX_WAIT_TIMEOUT = 300
+WAIT_RECHECK_INTERVAL = 1.0
 
-loop = tornado.ioloop.IOLoop.instance()
 
 
 class DefaultHandler(tornado.web.RequestHandler):
+    # collections each queryable reads from, keyed on signature, and
+    # collections insertables write to, driving the optional response cache.
+    # Queryables without reads are never cached
+    reads = {}
+    writes = ()
+    # type of the documents pushed to subscribers on insert and the payload
+    # key of bulk insertables holding them. None if nothing is pushed
+    doc_type = None
+    bulk_key = None
+    # metric labels and counters of the current request
+    _signature = ''
+    _response_bytes = 0
+
     def initialize(self):
         self.astore = self.settings['astore']
 
+    def write(self, chunk):
+        if not isinstance(chunk, dict):
+            chunk = utf8(chunk)
+            self._response_bytes += len(chunk)
+        super(DefaultHandler, self).write(chunk)
+
+    def on_finish(self):
+        metrics = self.settings.get('metrics')
+        if metrics is None:
+            return
+        labels = dict(handler=type(self).__name__, signature=self._signature)
+        metrics.inc('analysisstore_requests_total', method=self.request.method,
+                    code=self.get_status(), **labels)
+        metrics.observe('analysisstore_request_duration_seconds',
+                        self.request.request_time(), **labels)
+        if self.request.method == 'POST':
+            size = len(self.request.body)
+        else:
+            size = len(self.request.query)
+        metrics.observe('analysisstore_request_bytes', size, **labels)
+        metrics.observe('analysisstore_response_bytes', self._response_bytes,
+                        **labels)
+
     @gen.coroutine
     def set_default_headers(self):
         self.set_header('Access-Control-Allow-Origin', '*')
@@ -37,6 +89,67 @@ class DefaultHandler(tornado.web.RequestHandler):
         Useful for streaming client"""
         pass
 
+    def run_storage(self, func, payload, exhaust=True, query=True):
+        """Run a blocking AStore call on the storage executor so that a slow
+        query does not stall the IOLoop for every other client.
+
+        Parameters
+        ----------
+        func : callable
+            AStore routine resolved from the request signature
+        payload : dict
+            Keyword arguments for ``func``
+        exhaust : bool, optional
+            If False, generators are returned as is for streaming
+        query : bool, optional
+            If False, as for inserts, the call is timed but not logged
+
+        Returns
+        -------
+        asyncio.Future
+            Resolves to the result of ``func``. Generators are exhausted in
+            the executor thread, as iterating a pymongo cursor blocks.
+
+        Every call is timed and recorded in the metrics. Queries are also
+        logged together with their shape, at warning level above the
+        ``slow_query_ms`` setting. Streamed calls are timed up to opening
+        the cursor only.
+        """
+        def _call():
+            start = time.monotonic()
+            try:
+                res = func(**payload)
+                if exhaust and isinstance(res, types.GeneratorType):
+                    res = list(res)
+                return res
+            finally:
+                self.record_storage_call(func.__name__,
+                                         payload if query else None,
+                                         time.monotonic() - start)
+        return tornado.ioloop.IOLoop.current().run_in_executor(
+            self.settings.get('executor'), _call)
+
+    def record_storage_call(self, signature, payload, duration):
+        """Record the duration of a storage call in the metrics and log it
+        with the shape of its payload, as a warning if it exceeds the slow
+        query threshold. Nothing is logged without a payload"""
+        metrics = self.settings.get('metrics')
+        if metrics is not None:
+            metrics.observe('analysisstore_storage_duration_seconds', duration,
+                            signature=signature)
+        if payload is None:
+            return
+        threshold = self.settings.get('slow_query_ms', DEFAULT_SLOW_QUERY_MS)
+        ms = duration * 1000
+        if ms >= threshold:
+            level = logging.WARNING
+        elif logger.isEnabledFor(logging.DEBUG):
+            level = logging.DEBUG
+        else:
+            return
+        logger.log(level, "%s %s took %.1f ms", signature,
+                   query_shape(payload), ms)
+
     def report_error(self, code, status, mstr=''):
         fmsg = str(status) + ' ' + str(mstr)
         raise tornado.web.HTTPError(status_code=code, reason=fmsg)
@@ -52,12 +165,50 @@ class DefaultHandler(tornado.web.RequestHandler):
             signature = query.pop('signature')
         except KeyError:
             self.report_error(400, 'No signature provided by the client')
+        stream = query.pop('stream', False)
         func = self.get_queryable(signature)
-        docs_gen = func(**payload)
-        if isinstance(docs_gen, (doct.Document, list, dict)):
-            self.write(json.dumps(docs_gen))
-        elif isinstance(docs_gen, types.GeneratorType):
-            self.write(json.dumps(list(docs_gen)))
+        if stream and not signature.startswith('find_'):
+            # only find_* accept lazy and return a cursor to stream
+            self.report_error(400, 'Only find_* queries can be streamed',
+                              signature)
+        if (isinstance(payload, dict) and 'since' in payload and
+                self.settings.get('workers', 1) != 1):
+            # insert_seq visibility is only tracked within one process
+            self.report_error(400, 'since requires a single server worker',
+                              signature)
+        self._signature = signature
+        cache = self.settings.get('response_cache')
+        key = None
+        # coroutine queryables run on the IOLoop and may wait for inserts,
+        # their responses are never cached
+        waits = gen.is_coroutine_function(func)
+        reads = self.reads.get(signature)
+        if cache is not None and reads and not stream and not waits:
+            key = cache.key(signature, payload, reads)
+            body = cache.get(key)
+            if body is not None:
+                self.write(body)
+                self.finish()
+                return
+        try:
+            if stream:
+                # find_* hand back the open cursor instead of a list
+                docs = yield self.run_storage(func, dict(payload, lazy=True),
+                                              exhaust=False)
+            elif waits:
+                docs = yield func(**payload)
+            else:
+                docs = yield self.run_storage(func, payload)
+        except AnalysisstoreException as err:
+            self.report_error(400, 'Invalid query', err)
+        if isinstance(docs, types.GeneratorType):
+            yield return2client(self, docs)
+            return
+        if isinstance(docs, (doct.Document, list, dict, int)):
+            body = json.dumps(docs)
+            if key is not None:
+                cache.put(key, body)
+            self.write(body)
         self.finish()
 
     @gen.coroutine
@@ -72,9 +223,54 @@ class DefaultHandler(tornado.web.RequestHandler):
         except KeyError:
             self.report_error(400, 'A payload field must exist for post')
         func = self.get_insertable(signature)
-        func(**payload)
-        self.write(ujson.dumps({'status': True}))
+        self._signature = signature
+        cache = self.settings.get('response_cache')
+        subscriptions = self.settings.get('subscriptions')
+        docs = None
+        if subscriptions and self.doc_type is not None:
+            # copied before storage encodes them in place
+            docs = self.wire_docs(signature, payload)
+        try:
+            res = yield self.run_storage(func, payload, query=False)
+        except AnalysisstoreException as err:
+            self.report_error(400, 'Invalid insert', err)
+        finally:
+            # bulk inserts may have written part of the batch before failing
+            if cache is not None:
+                cache.bump(*self.writes)
+        self.write(ujson.dumps({'status': True, 'result': res}))
         self.finish()
+        self.on_insert(signature, payload)
+        if docs:
+            if signature.startswith('bulk_'):
+                inserted = set(res['inserted'])
+                docs = [d for d in docs if d['uid'] in inserted]
+            yield self.publish(subscriptions, docs)
+
+    def on_insert(self, signature, payload):
+        """Called once an insertable succeeded and the response is sent"""
+        pass
+
+    def wire_docs(self, signature, payload):
+        """Copy the documents of an insert payload as sent by the client,
+        with uids as foreign keys"""
+        if signature.startswith('bulk_'):
+            docs = [dict(d) for d in payload[self.bulk_key]]
+        else:
+            docs = [dict(payload)]
+        for doc in docs:
+            doc.pop('write_concern', None)
+            for key in SUBSCRIPTION_KEYS:
+                if key in doc:
+                    doc[key] = self.astore.doc_or_uid_to_uid(doc[key])
+            if isinstance(doc.get('data'), dict):
+                doc['data'] = dict(doc['data'])
+        return docs
+
+    @gen.coroutine
+    def publish(self, subscriptions, docs):
+        """Push inserted documents to websocket subscribers"""
+        subscriptions.publish(self.doc_type, docs)
 
     def get_insertable(self, func):
         try:
@@ -95,6 +291,59 @@ class ConnStatHandler(DefaultHandler):
         self.finish()
 
 
+class SubscriptionHandler(tornado.websocket.WebSocketHandler):
+    """Pushes documents to websocket clients as they are inserted.
+
+    A client sends ``{"data_reference_header": uid}`` to receive the data
+    references of a data reference header, or ``{"analysis_header": uid}``
+    to receive the data reference headers, analysis tails and data
+    references of an analysis header. Each subscription is acknowledged with
+    ``{"subscribed": {...}}``. Inserted documents arrive as
+    ``{"doc_type": ..., "docs": [...]}``, in the form they were sent by the
+    inserting client.
+
+    Only inserts handled by the same server process are pushed.
+    """
+    def initialize(self):
+        self.subscriptions = self.settings['subscriptions']
+
+    def check_origin(self, origin):
+        # same policy as the Access-Control-Allow-Origin of DefaultHandler
+        return True
+
+    def on_message(self, message):
+        try:
+            request = ujson.loads(message)
+        except ValueError:
+            request = None
+        if (not isinstance(request, dict) or not request or
+                not set(request).issubset(SUBSCRIPTION_KEYS) or
+                not all(isinstance(v, str) for v in request.values())):
+            self.close(1003, 'Subscribe with a uid per key among '
+                             '{}'.format(', '.join(SUBSCRIPTION_KEYS)))
+            return
+        for key, uid in request.items():
+            self.subscriptions.subscribe(key, uid, self)
+        self.write_message(ujson.dumps(dict(subscribed=request)))
+
+    def on_close(self):
+        self.subscriptions.unsubscribe(self)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Exports request, storage and IOLoop metrics of this server process in
+    the Prometheus text exposition format.
+
+    Methods
+    -------
+    get()
+        Render all metrics
+    """
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(self.settings['metrics'].render())
+
+
 class AnalysisHeaderHandler(DefaultHandler):
     """Handler for analysis_header insert, query, and update operations.
     No deletes are supported.
@@ -108,11 +357,22 @@ class AnalysisHeaderHandler(DefaultHandler):
     post()
         Insert analysis_header documents.
     """
+    reads = {'find_analysis_header': ('analysis_header',),
+             'count_analysis_header': ('analysis_header',),
+             'distinct_analysis_header': ('analysis_header',),
+             'get_analysis_tree': ('analysis_header', 'analysis_tail',
+                                   'data_reference_header', 'data_reference')}
+    writes = ('analysis_header',)
+
     def initialize(self):
         # Extends tornado specific handler
         self.astore = self.settings['astore']
-        self.insertables = {'insert_analysis_header': self.astore.insert_analysis_header}
-        self.queryables = {'find_analysis_header': self.astore.find_analysis_header}
+        self.insertables = {'insert_analysis_header': self.astore.insert_analysis_header,
+                            'bulk_analysis_header_insert': self.astore.bulk_analysis_header_insert}
+        self.queryables = {'find_analysis_header': self.astore.find_analysis_header,
+                           'count_analysis_header': self.astore.count_analysis_header,
+                           'distinct_analysis_header': self.astore.distinct_analysis_header,
+                           'get_analysis_tree': self.astore.get_analysis_tree}
 
 
 class AnalysisTailHandler(DefaultHandler):
@@ -127,11 +387,79 @@ class AnalysisTailHandler(DefaultHandler):
         safety net.
     """
 
+    reads = {'find_analysis_tail': ('analysis_tail',),
+             'count_analysis_tail': ('analysis_tail',),
+             'distinct_analysis_tail': ('analysis_tail',)}
+    writes = ('analysis_tail',)
+    doc_type = 'analysis_tail'
+    bulk_key = 'analysis_tails'
+
     def initialize(self):
         # Extends tornado specific handler
         self.astore = self.settings['astore']
-        self.insertables = {'insert_analysis_tail': self.astore.insert_analysis_tail}
-        self.queryables = {'find_analysis_tail': self.astore.find_analysis_tail}
+        self.insertables = {'insert_analysis_tail': self.astore.insert_analysis_tail,
+                            'bulk_analysis_tail_insert': self.astore.bulk_analysis_tail_insert}
+        self.queryables = {'find_analysis_tail': self.astore.find_analysis_tail,
+                           'count_analysis_tail': self.astore.count_analysis_tail,
+                           'distinct_analysis_tail': self.astore.distinct_analysis_tail,
+                           'wait_analysis_tail': self.wait_analysis_tail}
+
+    @gen.coroutine
+    def wait_analysis_tail(self, uid, timeout=DEFAULT_WAIT_TIMEOUT):
+        """Hold the request until an analysis tail of the analysis header is
+        inserted, without blocking the IOLoop
+
+        Parameters
+        ----------
+        uid : str
+            uid of the analysis header
+        timeout : float, optional
+            Seconds to wait at most, capped at MAX_WAIT_TIMEOUT
+
+        Returns
+        -------
+        list
+            Analysis tails of the header, empty if none was inserted in time
+        """
+        if (isinstance(timeout, bool) or
+                not isinstance(timeout, (int, float)) or timeout <= 0):
+            raise AnalysisstoreException('timeout must be a positive number')
+        loop = tornado.ioloop.IOLoop.current()
+        deadline = loop.time() + min(timeout, MAX_WAIT_TIMEOUT)
+        waiters = self.settings['waiters']
+        # a single process sees every insert, no need to poll the database
+        interval = MAX_WAIT_TIMEOUT
+        if self.settings.get('workers', 1) != 1:
+            interval = WAIT_RECHECK_INTERVAL
+        # registered before the first check so that no insert is missed
+        event = waiters.register(uid)
+        try:
+            while True:
+                event.clear()
+                tails = yield self.run_storage(self.astore.find_analysis_tail,
+                                               dict(analysis_header=uid))
+                remaining = deadline - loop.time()
+                if tails or remaining <= 0:
+                    return tails
+                try:
+                    yield event.wait(
+                        timeout=loop.time() + min(remaining, interval))
+                except gen.TimeoutError:
+                    pass
+        finally:
+            waiters.unregister(uid, event)
+
+    def on_insert(self, signature, payload):
+        waiters = self.settings.get('waiters')
+        if waiters is None:
+            return
+        if signature.startswith('bulk_'):
+            docs = payload[self.bulk_key]
+        else:
+            docs = [payload]
+        for uid in set(self.astore.doc_or_uid_to_uid(d['analysis_header'])
+                       for d in docs):
+            waiters.notify(uid)
 
 
 class DataReferenceHeaderHandler(DefaultHandler):
@@ -145,11 +473,21 @@ class DataReferenceHeaderHandler(DefaultHandler):
         Insert a event_header document.Same validation method as bluesky, secondary
         safety net.
     """
+    reads = {'find_data_reference_header': ('data_reference_header',),
+             'count_data_reference_header': ('data_reference_header',),
+             'distinct_data_reference_header': ('data_reference_header',)}
+    writes = ('data_reference_header',)
+    doc_type = 'data_reference_header'
+    bulk_key = 'data_reference_headers'
+
     @gen.coroutine
     def initialize(self):
         self.astore = self.settings['astore']
-        self.insertables = dict(insert_data_reference_header=self.astore.insert_data_reference_header)
-        self.queryables = {'find_data_reference_header': self.astore.find_data_reference_header}
+        self.insertables = dict(insert_data_reference_header=self.astore.insert_data_reference_header,
+                                bulk_data_reference_header_insert=self.astore.bulk_data_reference_header_insert)
+        self.queryables = {'find_data_reference_header': self.astore.find_data_reference_header,
+                           'count_data_reference_header': self.astore.count_data_reference_header,
+                           'distinct_data_reference_header': self.astore.distinct_data_reference_header}
 
 
 class DataReferenceHandler(DefaultHandler):
@@ -164,9 +502,72 @@ class DataReferenceHandler(DefaultHandler):
         Insert a event document.Same validation method as bluesky, secondary
         safety net.
     """
+    # the summary is maintained by data_reference inserts
+    reads = {'find_data_reference': ('data_reference',),
+             'count_data_reference': ('data_reference',),
+             'distinct_data_reference': ('data_reference',),
+             'aggregate_data_reference': ('data_reference',),
+             'get_data_reference_blob': ('data_reference',),
+             'get_data_reference_summary': ('data_reference',)}
+    writes = ('data_reference',)
+    doc_type = 'data_reference'
+    bulk_key = 'data_references'
+
     @gen.coroutine
     def initialize(self):
         self.astore = self.settings['astore']
         self.insertables = dict(insert_data_reference=self.astore.insert_data_reference,
                                 bulk_data_reference_insert=self.astore.bulk_data_reference_insert)
-        self.queryables = {'find_data_reference': self.astore.find_data_reference}
+        self.queryables = {'find_data_reference': self.astore.find_data_reference,
+                           'count_data_reference': self.astore.count_data_reference,
+                           'distinct_data_reference': self.astore.distinct_data_reference,
+                           'aggregate_data_reference': self.astore.aggregate_data_reference,
+                           'get_data_reference_blob': self.astore.get_data_reference_blob,
+                           'get_data_reference_summary': self.astore.get_data_reference_summary}
+
+    def wire_docs(self, signature, payload):
+        docs = super(DataReferenceHandler, self).wire_docs(signature, payload)
+        if signature == 'bulk_data_reference_insert':
+            dhdr = self.astore.doc_or_uid_to_uid(payload['data_header'])
+            for doc in docs:
+                doc['data_reference_header'] = dhdr
+        return docs
+
+    @gen.coroutine
+    def publish(self, subscriptions, docs):
+        if subscriptions.wants('analysis_header'):
+            # analysis header subscribers also get the data references
+            for dhdr in set(d['data_reference_header'] for d in docs):
+                if subscriptions.parent(dhdr) is not None:
+                    continue
+                hdrs = yield self.run_storage(
+                    self.astore.find_data_reference_header,
+                    dict(uid=dhdr, fields=['analysis_header']))
+                if hdrs:
+                    subscriptions.add_parent(dhdr, hdrs[0]['analysis_header'])
+        subscriptions.publish(self.doc_type, docs)
+
+
+class AdminHandler(DefaultHandler):
+    """Handler for operational queries against the service itself.
+    No inserts are supported.
+
+    Methods
+    -------
+    get()
+        Run an administrative query, such as the index report, the cache
+        statistics or the query plan of a find_* query
+    """
+    def initialize(self):
+        self.astore = self.settings['astore']
+        self.insertables = dict()
+        self.queryables = {'index_report': self.astore.index_report,
+                           'cache_stats': self.cache_stats,
+                           'explain': self.astore.explain}
+
+    def cache_stats(self):
+        stats = self.astore.cache_stats()
+        cache = self.settings.get('response_cache')
+        if cache is not None:
+            stats['response'] = cache.stats()
+        return stats
@@ -0,0 +1,125 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import threading
+import tornado.ioloop
+
+
+# Upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+# Upper bounds of payload size histogram buckets, in bytes
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                 16777216)
+# Seconds between two IOLoop lag probes
+LAG_PROBE_INTERVAL = 0.5
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'analysisstore_requests_total': (
+        'counter', 'Requests handled', None),
+    'analysisstore_request_duration_seconds': (
+        'histogram', 'Time to handle a request', LATENCY_BUCKETS),
+    'analysisstore_request_bytes': (
+        'histogram', 'Size of request payloads', BYTES_BUCKETS),
+    'analysisstore_response_bytes': (
+        'histogram', 'Size of response bodies', BYTES_BUCKETS),
+    'analysisstore_storage_duration_seconds': (
+        'histogram', 'Time spent in database calls', LATENCY_BUCKETS),
+    'analysisstore_ioloop_lag_seconds': (
+        'histogram', 'Delay of IOLoop callbacks past their due time',
+        LATENCY_BUCKETS),
+}
+
+
+def _format_labels(labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\')
+                                      .replace('"', r'\"'))
+                    for k, v in labels)
+
+
+def _braces(labels):
+    return '{{{}}}'.format(labels) if labels else ''
+
+
+class Metrics:
+    """Thread safe registry of the counters and histograms declared in
+    METRICS, rendered in the Prometheus text exposition format.
+
+    Values live in this process only. With several server workers every
+    scrape reaches a single worker, which should be told apart by the
+    scraper (e.g. one port per worker) or aggregated upstream.
+    """
+    def __init__(self):
+        self._values = {name: dict() for name in METRICS}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Add value to the counter name for the given labels"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record value in the histogram name for the given labels"""
+        buckets = METRICS[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            if key not in series:
+                # per bucket counts, then sum and count
+                series[key] = [0] * len(buckets) + [0.0, 0]
+            hist = series[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, (kind, doc, buckets) in sorted(METRICS.items()):
+                lines.append('# HELP {} {}'.format(name, doc))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for key, value in sorted(self._values[name].items()):
+                    labels = _format_labels(key)
+                    if kind == 'counter':
+                        lines.append('{}{} {}'.format(name, _braces(labels),
+                                                      value))
+                        continue
+                    sep = ',' if labels else ''
+                    for bound, n in zip(buckets, value):
+                        lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(
+                            name, labels, sep, bound, n))
+                    lines.append('{}_bucket{{{}{}le="+Inf"}} {}'.format(
+                        name, labels, sep, value[-1]))
+                    lines.append('{}_sum{} {}'.format(name, _braces(labels),
+                                                      value[-2]))
+                    lines.append('{}_count{} {}'.format(name, _braces(labels),
+                                                        value[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def start_lag_monitor(metrics, interval=LAG_PROBE_INTERVAL):
+    """Schedule a callback every interval seconds on the current IOLoop and
+    record how late it runs. A blocked IOLoop shows up as lag.
+
+    Parameters
+    ----------
+    metrics : Metrics
+        Registry the lag is recorded in
+    interval : float, optional
+        Seconds between two probes
+    """
+    loop = tornado.ioloop.IOLoop.current()
+
+    def _probe(due):
+        metrics.observe('analysisstore_ioloop_lag_seconds',
+                        max(loop.time() - due, 0))
+        due = loop.time() + interval
+        loop.call_at(due, _probe, due)
+
+    due = loop.time() + interval
+    loop.call_at(due, _probe, due)
@@ -0,0 +1,159 @@
+"""Conversions of data_reference payloads between their wire (JSON) and
+stored (BSON) representations"""
+import base64
+import binascii
+import re
+import zlib
+import bson
+from bson import Binary
+from .utils import AnalysisstoreException
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Marks a data value holding a binary array. The value is a dict with the
+# raw bytes under this key plus ``dtype`` (numpy dtype string, e.g. '<f8')
+# and ``shape``. On the wire the bytes are base64 encoded, in Mongo they are
+# stored as BSON binary.
+NDARRAY_KEY = '__ndarray__'
+
+# Marks a data value moved to a blob store. The value is a dict with the
+# blob key under this key and the encoded ``size`` in bytes.
+BLOB_KEY = '__blob__'
+
+# Marks a compressed data or timestamps value. The value is a dict with the
+# codec name under this key and the compressed BSON encoding of the value
+# under ``payload``.
+CODEC_KEY = '__codec__'
+
+
+# numpy array-protocol type strings, e.g. '<f8', '|u1', '<U5', '<M8[ns]'.
+# Object arrays ('|O') carry pointers rather than data and are refused.
+_DTYPE = re.compile(r'^[<>|=]?([biufcmMSUV])(\d+)(\[\w+\])?$')
+
+
+def itemsize(dtype):
+    """Bytes per element of a numpy dtype string, without importing numpy
+
+    Raises
+    ------
+    AnalysisstoreException
+        If dtype is not a fixed size numpy type string
+    """
+    match = _DTYPE.match(dtype) if isinstance(dtype, str) else None
+    if match is None:
+        raise AnalysisstoreException('Unsupported array dtype {!r}'.format(dtype))
+    kind, size = match.group(1), int(match.group(2))
+    # unicode strings are stored as UCS4
+    return size * 4 if kind == 'U' else size
+
+
+def is_array(value):
+    return isinstance(value, dict) and NDARRAY_KEY in value
+
+
+def arrays_to_binary(data):
+    """Replace, in place, the base64 array values of a data dict by BSON
+    binary so that they are stored as raw bytes instead of arrays of doubles
+
+    Raises
+    ------
+    AnalysisstoreException
+        If an array value is malformed
+    """
+    for key, value in data.items():
+        if not is_array(value):
+            continue
+        if 'dtype' not in value or 'shape' not in value:
+            raise AnalysisstoreException('Array {} requires dtype and shape'.format(key))
+        try:
+            raw = base64.b64decode(value[NDARRAY_KEY], validate=True)
+        except (binascii.Error, TypeError, ValueError):
+            raise AnalysisstoreException('Array {} is not base64 encoded'.format(key))
+        shape = value['shape']
+        if (not isinstance(shape, list) or
+                not all(isinstance(n, int) and n >= 0 for n in shape)):
+            raise AnalysisstoreException('Array {} has an invalid shape'.format(key))
+        nbytes = itemsize(value['dtype'])
+        for n in shape:
+            nbytes *= n
+        if len(raw) != nbytes:
+            raise AnalysisstoreException(
+                'Array {} holds {} bytes, {} and shape {} require {}'.format(
+                    key, len(raw), value['dtype'], shape, nbytes))
+        data[key] = dict(value, **{NDARRAY_KEY: Binary(raw)})
+    return data
+
+
+def arrays_to_base64(data):
+    """Inverse of ``arrays_to_binary``, run on documents read from Mongo.
+    Only the buffer is re-encoded, no per element objects are created."""
+    for key, value in data.items():
+        if is_array(value) and isinstance(value[NDARRAY_KEY], bytes):
+            value[NDARRAY_KEY] = base64.b64encode(value[NDARRAY_KEY]).decode('ascii')
+    return data
+
+
+def offload_blobs(data, store, threshold):
+    """Move, in place, the values of a data dict whose BSON encoding exceeds
+    threshold bytes to store, leaving a blob reference behind"""
+    for key, value in data.items():
+        content = bson.encode({'value': value})
+        if len(content) > threshold:
+            data[key] = {BLOB_KEY: store.put(content), 'size': len(content)}
+    return data
+
+
+def load_blob(store, key):
+    """Read back a value written by ``offload_blobs`` in its wire form"""
+    value = bson.decode(store.get(key))['value']
+    return arrays_to_base64({'value': value})['value']
+
+
+def _codecs():
+    """Available compression codecs as name: (compress, decompress)"""
+    codecs = {'zlib': (zlib.compress, zlib.decompress)}
+    if zstandard is not None:
+        codecs['zstd'] = (zstandard.ZstdCompressor().compress,
+                          zstandard.ZstdDecompressor().decompress)
+    return codecs
+
+
+CODECS = _codecs()
+
+
+def check_codec(codec):
+    """Raise AnalysisstoreException unless codec is available"""
+    if codec not in CODECS:
+        raise AnalysisstoreException('Compression codec {} is not available, '
+                                     'choose from {}'.format(codec, sorted(CODECS)))
+
+
+def compress_values(fields, codec, threshold):
+    """Compress, in place, the values of a data or timestamps dict whose BSON
+    encoding exceeds threshold bytes. Values that compression does not
+    shrink are kept as is, so are small values, which stay queryable."""
+    for key, value in fields.items():
+        content = bson.encode({'value': value})
+        if len(content) <= threshold:
+            continue
+        compressed = CODECS[codec][0](content)
+        if len(compressed) < len(content):
+            fields[key] = {CODEC_KEY: codec, 'payload': Binary(compressed)}
+    return fields
+
+
+def decompress_values(fields):
+    """Inverse of ``compress_values``, in place"""
+    for key, value in fields.items():
+        if not (isinstance(value, dict) and CODEC_KEY in value):
+            continue
+        try:
+            decompress = CODECS[value[CODEC_KEY]][1]
+        except KeyError:
+            raise AnalysisstoreException('Compression codec {} is not available '
+                                         'to read this document'.format(value[CODEC_KEY]))
+        fields[key] = bson.decode(decompress(bytes(value['payload'])))['value']
+    return fields
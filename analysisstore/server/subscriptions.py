@@ -0,0 +1,112 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from collections import defaultdict
+import ujson
+from tornado.locks import Event
+from tornado.websocket import WebSocketClosedError
+from .cache import UidCache, DEFAULT_UID_CACHE_SIZE
+
+# Keys documents can be subscribed to by
+SUBSCRIPTION_KEYS = ('analysis_header', 'data_reference_header')
+
+
+class Subscriptions:
+    """In-process fan-out of newly inserted documents to websocket
+    subscribers, keyed on the uid of a header.
+
+    Only used from the IOLoop thread, hence no locking. Inserts are only seen
+    by the subscribers of the server process that handled them.
+
+    Parameters
+    ----------
+    parent_cache_size : int, optional
+        Number of data reference headers whose analysis header is remembered.
+        Evicted ones are looked up again by the handler publishing
+    """
+    def __init__(self, parent_cache_size=DEFAULT_UID_CACHE_SIZE):
+        self._subscribers = defaultdict(set)
+        # data_reference_header -> analysis_header, headers are immutable
+        self._parents = UidCache(parent_cache_size)
+
+    def __bool__(self):
+        return bool(self._subscribers)
+
+    def wants(self, key):
+        """Whether anyone subscribed by key"""
+        return any(k == key for k, _ in self._subscribers)
+
+    def subscribe(self, key, uid, handler):
+        """Push documents inserted under header uid of type key to handler"""
+        self._subscribers[(key, uid)].add(handler)
+
+    def unsubscribe(self, handler):
+        """Remove every subscription of handler"""
+        for k in [k for k, v in self._subscribers.items() if handler in v]:
+            self._subscribers[k].discard(handler)
+            if not self._subscribers[k]:
+                del self._subscribers[k]
+
+    def parent(self, dhdr):
+        """Known analysis_header of a data_reference_header, or None"""
+        return self._parents.get(dhdr)
+
+    def add_parent(self, dhdr, ahdr):
+        self._parents.add(dhdr, ahdr)
+
+    def publish(self, doc_type, docs):
+        """Send docs to the subscribers of the headers they belong to, one
+        message per subscriber
+
+        Parameters
+        ----------
+        doc_type : str
+            Collection the documents were inserted into
+        docs : list
+            Documents as sent by the client
+        """
+        pending = defaultdict(list)
+        for doc in docs:
+            if doc_type == 'data_reference_header':
+                self.add_parent(doc['uid'], doc['analysis_header'])
+            keys = [(k, doc.get(k)) for k in SUBSCRIPTION_KEYS]
+            if doc_type == 'data_reference':
+                keys.append(('analysis_header',
+                             self.parent(doc['data_reference_header'])))
+            for key in keys:
+                for handler in self._subscribers.get(key, ()):
+                    # subscribed by both the data and the analysis header
+                    if not pending[handler] or pending[handler][-1] is not doc:
+                        pending[handler].append(doc)
+        for handler, hdocs in pending.items():
+            try:
+                handler.write_message(ujson.dumps(dict(doc_type=doc_type,
+                                                       docs=hdocs)))
+            except WebSocketClosedError:
+                self.unsubscribe(handler)
+
+
+class Waiters:
+    """In-process wake-ups of long-polling requests, keyed on uid.
+
+    Only used from the IOLoop thread. Inserts handled by other server
+    processes wake nobody, so with several workers waiters must also recheck
+    periodically.
+    """
+    def __init__(self):
+        self._events = defaultdict(set)
+
+    def register(self, uid):
+        """Return an event set whenever notify(uid) is called"""
+        event = Event()
+        self._events[uid].add(event)
+        return event
+
+    def unregister(self, uid, event):
+        self._events[uid].discard(event)
+        if not self._events[uid]:
+            del self._events[uid]
+
+    def notify(self, uid):
+        """Wake every request waiting on uid"""
+        for event in self._events.get(uid, ()):
+            event.set()
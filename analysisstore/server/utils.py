@@ -1,14 +1,25 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+from tornado import gen
+import tornado.ioloop
 import tornado.web
+import itertools
+import json
 from pkg_resources import resource_filename as rs_fn
+import base64
+import binascii
 import ujson
-import pymongo.cursor
 
 class AnalysisstoreException(Exception):
     pass
 
 
+# Number of documents serialized and flushed at once by streaming responses
+STREAM_CHUNK_SIZE = 500
+# Longest query shape logged, in characters
+MAX_SHAPE_LENGTH = 1024
+
+
 SCHEMA_PATH = 'schemas'
 SCHEMA_NAMES = {'analysis_header': 'analysis_header.json',
                 'analysis_tail': 'analysis_tail.json',
@@ -25,6 +36,75 @@ def _compose_err_msg(code, status, m_str=''):
     reason = status + str(m_str)
     return tornado.web.HTTPError(code, reason=reason )
 
+def query_shape(payload):
+    """Reduce a query payload to its shape, replacing every value with '?'
+    while keeping field names and operators, so that the same query with
+    different values is logged and grouped identically. Lists of documents
+    other than operator clauses and pipelines are summarized by their length
+    and the shape is cut at MAX_SHAPE_LENGTH characters.
+
+    Parameters
+    ----------
+    payload : dict
+        Query in mongo query format
+
+    Returns
+    -------
+    str
+        Shape of the query as json with sorted keys
+    """
+    def _shape(value, key=''):
+        if isinstance(value, dict):
+            return {k: _shape(v, k) for k, v in value.items()}
+        if isinstance(value, list) and any(isinstance(v, dict) for v in value):
+            if key.startswith('$') or key == 'pipeline':
+                # $and/$or clauses and aggregation pipelines
+                return [_shape(v) for v in value]
+            return '[{} docs]'.format(len(value))
+        return '?'
+    shape = json.dumps(_shape(payload), sort_keys=True)
+    if len(shape) > MAX_SHAPE_LENGTH:
+        shape = shape[:MAX_SHAPE_LENGTH - 3] + '...'
+    return shape
+
+
+def encode_page_token(time, uid):
+    """Encode the sort key of the last document of a page into an opaque,
+    url safe token
+
+    Parameters
+    ----------
+    time : float
+        time field of the last document returned
+    uid : str
+        uid field of the last document returned
+
+    Returns
+    -------
+    str
+        Token to be passed back as ``next`` for the following page
+    """
+    raw = ujson.dumps([time, uid]).encode('utf-8')
+    # padding is stripped as queries travel as the key of the url arguments
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_page_token(token):
+    """Inverse of ``encode_page_token``
+
+    Raises
+    ------
+    AnalysisstoreException
+        If the token was not produced by ``encode_page_token``
+    """
+    try:
+        raw = token.encode('ascii') + b'=' * (-len(token) % 4)
+        time, uid = ujson.loads(base64.urlsafe_b64decode(raw))
+    except (ValueError, TypeError, AttributeError, binascii.Error):
+        raise AnalysisstoreException('Invalid next token {}'.format(token))
+    return time, uid
+
+
 def unpack_params(handler):
     """Unpacks the queries from the body of the header
     Parameters
@@ -42,38 +122,35 @@ def unpack_params(handler):
         raise TypeError("Handler provided must be of tornado.web.RequestHandler type")
 
 
-def return2client(handler, payload):
-    """Dump the result back to client's open socket. No need to worry about package size
-    or socket behavior as tornado handles this for us
+@gen.coroutine
+def return2client(handler, payload, chunk_size=STREAM_CHUNK_SIZE):
+    """Stream documents to the client's open socket as newline delimited
+    JSON, flushing after every chunk. Neither the result set nor its
+    serialized form is ever held in memory as a whole.
 
     Parameters
     -----------
     handler: tornado.web.RequestHandler
-        Request handler for the collection of operation(post/get)
-    payload: dict, list
-        Information to be sent to the client
+        Request handler for the collection of operation(get)
+    payload: iterator
+        Documents to be sent to the client. Pulled in the storage executor,
+        as iterating a pymongo cursor blocks
+    chunk_size: int
+        Number of documents written between two flushes
     """
-
-    
-    if isinstance(payload, pymongo.cursor.Cursor):
-            l = []
-            for p in payload:
-                del(p['_id'])
-                l.append(p)           
-            handler.write(ujson.dumps(l))
-    elif isinstance(payload, dict):
-        del(payload['_id'])
-        handler.write(ujson.dumps(list(payload)))
-    else:
-        handler.write('[')
-        d = next(payload)
+    loop = tornado.ioloop.IOLoop.current()
+    executor = handler.settings.get('executor')
+    handler.set_header('Content-type', 'application/x-ndjson')
+    try:
         while True:
-            try:
-                del(d['_id'])
-                handler.write(ujson.dumps(d))
-                d = next(payload)
-                handler.write(',')
-            except StopIteration:
+            chunk = yield loop.run_in_executor(
+                executor, list, itertools.islice(payload, chunk_size))
+            if not chunk:
                 break
-        handler.write(']')
-    handler.finish()
+            handler.write(''.join(json.dumps(d) + '\n' for d in chunk))
+            yield handler.flush()
+        handler.finish()
+    finally:
+        close = getattr(payload, 'close', None)
+        if close is not None:
+            close()
@@ -0,0 +1,66 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import jsonschema
+from .utils import AnalysisstoreException, schemas
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+
+# Document types validated on insert, keyed as in utils.schemas
+VALIDATED = ('analysis_header', 'analysis_tail', 'data_reference_header',
+             'data_reference')
+
+
+def compile_validator(schema):
+    """Compile schema once into a callable raising AnalysisstoreException on
+    invalid documents. fastjsonschema generates python code for the schema if
+    installed, otherwise a jsonschema validator is built once and reused.
+
+    Parameters
+    ----------
+    schema : dict
+        JSON schema
+
+    Returns
+    -------
+    callable
+        Validates a document
+    """
+    if fastjsonschema is not None:
+        validate = fastjsonschema.compile(schema)
+
+        def _validate(doc):
+            try:
+                validate(doc)
+            except fastjsonschema.JsonSchemaException as err:
+                raise AnalysisstoreException(err.message)
+        return _validate
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    validator = cls(schema)
+
+    def _validate(doc):
+        err = jsonschema.exceptions.best_match(validator.iter_errors(doc))
+        if err is not None:
+            path = '.'.join(str(p) for p in err.absolute_path)
+            raise AnalysisstoreException('{}: {}'.format(path or 'document',
+                                                         err.message))
+    return _validate
+
+
+def compile_validators():
+    """Validators of single documents and of lists of documents, keyed on
+    document type and bulk_<document type>. A list is validated in a single
+    call instead of one call per document."""
+    validators = {}
+    for name in VALIDATED:
+        validators[name] = compile_validator(schemas[name])
+        items = dict(schemas[name])
+        bulk = dict(type='array', items=items)
+        # local $refs resolve against the root of the list schema
+        if 'definitions' in items:
+            bulk['definitions'] = items.pop('definitions')
+        validators['bulk_' + name] = compile_validator(bulk)
+    return validators
@@ -20,19 +20,25 @@ testing_config = dict(
     testing=True,
     log_file_prefix="testing",
 )
+# Server with the response cache enabled, for the tests covering it only
+cached_config = dict(testing_config, service_port=7602,
+                     response_cache_size=1 << 20)
 
 
 @contextlib.contextmanager
-def astore_startup():
+def astore_startup(config=testing_config):
     ps = subprocess.Popen(
         [
             sys.executable,
             "-c",
-            f"from analysisstore.ignition import start_server; start_server(config={testing_config}) ",
+            f"from analysisstore.ignition import start_server; start_server(config={config}) ",
         ],
     )
     ttime.sleep(1.3)  # make sure the process is started
-    yield ps
+    try:
+        yield ps
+    finally:
+        ps.terminate()
 
 
 @pytest.fixture(scope="session")
@@ -47,3 +53,16 @@ def astore_client():
         {"host": testing_config["mongo_host"], "port": testing_config["service_port"]}
     )
     return c
+
+
+@pytest.fixture(scope="module")
+def astore_cached_server():
+    with astore_startup(cached_config):
+        yield
+
+
+@pytest.fixture(scope="function")
+def astore_cached_client():
+    return AnalysisClient(
+        {"host": cached_config["mongo_host"], "port": cached_config["service_port"]}
+    )
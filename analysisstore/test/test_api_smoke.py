@@ -1,5 +1,13 @@
 from ..client.commands import AnalysisClient
+from ..server.astore import INDEXES
 
 
 def test_client_api():
     cli = AnalysisClient
+
+
+def test_index_report(astore_server, astore_client):
+    report = astore_client.index_report()
+    assert set(report) == set(INDEXES)
+    for collection in report.values():
+        assert collection["missing"] == []
@@ -0,0 +1,482 @@
+import base64
+from ..server import astore as astore_module
+from ..server.astore import AStore, INDEXES
+from ..server.cache import UidCache, ResponseCache
+from ..server.utils import (AnalysisstoreException, query_shape,
+                            MAX_SHAPE_LENGTH)
+import mongomock
+import pytest
+import time
+import uuid
+
+
+@pytest.fixture(scope="function")
+def astore():
+    config = dict(uri="mongodb://localhost",
+                  database="astoretest{0}".format(str(uuid.uuid4())))
+    return AStore(config, testing=True)
+
+
+def test_ensure_indexes(astore):
+    report = astore.index_report()
+    assert all(report[c]["missing"] for c in INDEXES)
+    created = astore.ensure_indexes()
+    assert set(created) == set(INDEXES)
+    report = astore.index_report()
+    for collection in INDEXES:
+        assert report[collection]["missing"] == []
+    # idempotent
+    astore.ensure_indexes()
+    assert astore.index_report() == report
+
+
+def test_find_pagination(astore):
+    hid = astore.insert_analysis_header(time=time.time(), uid=str(uuid.uuid4()),
+                                        provenance={})
+    dhid = astore.insert_data_reference_header(time=time.time(),
+                                               uid=str(uuid.uuid4()),
+                                               analysis_header=hid,
+                                               data_keys={})
+    t0 = time.time()
+    for i in range(7):
+        # duplicate times exercise the uid tie breaker
+        astore.insert_data_reference(time=t0 + i // 2, uid=str(uuid.uuid4()),
+                                     data_reference_header=dhid,
+                                     data={'x': i}, timestamps={'x': t0})
+    expected = astore.find_data_reference(data_reference_header=dhid)
+    assert len(expected) == 7
+    seen = []
+    page = astore.find_data_reference(data_reference_header=dhid, limit=3)
+    while True:
+        seen.extend(page['data'])
+        if page['next'] is None:
+            break
+        page = astore.find_data_reference(data_reference_header=dhid, limit=3,
+                                          next=page['next'])
+    assert [d['uid'] for d in seen] == [d['uid'] for d in expected]
+    with pytest.raises(AnalysisstoreException):
+        astore.find_data_reference(limit=3, next='bogus')
+
+
+def test_find_projection(astore):
+    hid = astore.insert_analysis_header(time=time.time(), uid=str(uuid.uuid4()),
+                                        provenance={})
+    dhid = astore.insert_data_reference_header(time=time.time(),
+                                               uid=str(uuid.uuid4()),
+                                               analysis_header=hid,
+                                               data_keys={})
+    uid = astore.insert_data_reference(time=time.time(), uid=str(uuid.uuid4()),
+                                       data_reference_header=dhid,
+                                       data={'diffr1': 1, 'diffr2': 2},
+                                       timestamps={'diffr1': 0, 'diffr2': 0})
+    res, = astore.find_data_reference(uid=uid, fields=['data.diffr1'])
+    assert res == {'uid': uid, 'time': res['time'], 'data': {'diffr1': 1}}
+    res, = astore.find_data_reference(uid=uid)
+    assert '_id' not in res
+    assert set(res) == {'uid', 'time', 'data_reference_header', 'data',
+                        'timestamps', 'insert_seq'}
+
+
+def test_header_cache(astore):
+    hid = astore.insert_analysis_header(time=time.time(), uid=str(uuid.uuid4()),
+                                        provenance={})
+    assert astore.extract_verify_ahdr(hid) == hid
+    assert astore.cache_stats()['analysis_header']['hits'] == 1
+    with pytest.raises(RuntimeError):
+        astore.extract_verify_dhdr(str(uuid.uuid4()))
+    assert astore.cache_stats()['data_reference_header']['misses'] == 1
+
+
+def test_uid_cache_eviction():
+    cache = UidCache(2)
+    for uid in 'abc':
+        cache.add(uid)
+    assert 'a' not in cache
+    assert 'b' in cache and 'c' in cache
+    cache.add('d')
+    # 'c' was used after 'b', so 'b' is evicted
+    assert 'b' not in cache
+    assert cache.stats() == dict(hits=2, misses=2, size=2, maxsize=2)
+    cache.add('e', 'parent')
+    assert cache.get('e') == 'parent' and cache.get('d') is None
+    assert cache.get('c', 'evicted') == 'evicted'
+
+
+def test_response_cache():
+    cache = ResponseCache(10)
+    key = cache.key('find_analysis_header', {'b': 1, 'a': 2},
+                    ['analysis_header'])
+    # payload key order does not matter
+    assert key == cache.key('find_analysis_header', {'a': 2, 'b': 1},
+                            ['analysis_header'])
+    assert cache.get(key) is None
+    cache.put(key, '[1, 2]')
+    assert cache.get(key) == '[1, 2]'
+    cache.bump('analysis_tail')
+    assert cache.get(cache.key('find_analysis_header', {'a': 2, 'b': 1},
+                               ['analysis_header'])) == '[1, 2]'
+    cache.bump('analysis_header')
+    assert cache.get(cache.key('find_analysis_header', {'a': 2, 'b': 1},
+                               ['analysis_header'])) is None
+    for i in range(3):
+        cache.put(('k', i), '1234')
+    assert cache.get(key) is None and cache.get(('k', 0)) is None
+    assert cache.stats() == dict(hits=2, misses=4, size=2, nbytes=8,
+                                 maxbytes=10)
+
+
+def test_bulk_data_reference_insert(astore, monkeypatch):
+    monkeypatch.setattr(astore_module, 'BULK_BATCH_COUNT', 3)
+    astore.ensure_indexes()
+    dhid = str(uuid.uuid4())
+    drefs = [dict(time=time.time(), uid=str(uuid.uuid4()), data={'x': i},
+                  timestamps={'x': 0}) for i in range(8)]
+    res = astore.bulk_data_reference_insert(dhid, drefs[:5])
+    assert res == dict(inserted=[d['uid'] for d in drefs[:5]], failed=[])
+    # retrying overlapping documents only reports the duplicates as failed
+    drefs = [dict(d) for d in drefs]
+    for d in drefs:
+        d.pop('_id', None)
+    res = astore.bulk_data_reference_insert(dhid, drefs[3:])
+    assert res['inserted'] == [d['uid'] for d in drefs[5:]]
+    assert [f['uid'] for f in res['failed']] == [d['uid'] for d in drefs[3:5]]
+    assert len(astore.find_data_reference(data_reference_header=dhid)) == 8
+
+
+def test_write_concern():
+    config = dict(uri="mongodb://localhost", database="astoretest",
+                  write_concern={'w': 1, 'data_reference': {'w': 0}})
+    astore = AStore(config, testing=True)
+    assert astore._collection('analysis_header').write_concern.document == {'w': 1}
+    assert astore._collection('data_reference').write_concern.document == {'w': 0}
+    wc = astore._collection('data_reference', {'w': 1, 'j': True}).write_concern
+    assert wc.document == {'w': 1, 'j': True}
+    with pytest.raises(AnalysisstoreException):
+        astore.insert_analysis_header(time=time.time(), uid=str(uuid.uuid4()),
+                                      provenance={},
+                                      write_concern={'w': 0, 'j': True})
+    # unacknowledged inserts may land after later ones, since would skip them
+    with pytest.raises(AnalysisstoreException, match='unacknowledged'):
+        astore.find_data_reference(since=0)
+    assert astore.find_analysis_tail(since=0) == dict(data=[], since=0)
+    astore.insert_analysis_tail(time=time.time(), uid=str(uuid.uuid4()),
+                                analysis_header='ahdr', exit_status='success',
+                                write_concern={'w': 0})
+    with pytest.raises(AnalysisstoreException, match='unacknowledged'):
+        astore.find_analysis_tail(since=0)
+
+
+def test_aggregate_data_reference(astore):
+    dhid = str(uuid.uuid4())
+    astore.bulk_data_reference_insert(
+        dhid, [dict(time=float(i), uid=str(uuid.uuid4()), data={'x': float(i)},
+                    timestamps={'x': 0}) for i in range(10)])
+    res = astore.aggregate_data_reference([
+        {'$match': {'data_reference_header': dhid}},
+        {'$bucket': {'groupBy': '$time', 'boundaries': [0, 5, 10],
+                     'output': {'mean': {'$avg': '$data.x'},
+                                'max': {'$max': '$data.x'}}}}])
+    assert res == [{'_id': 0, 'mean': 2.0, 'max': 4.0},
+                   {'_id': 5, 'mean': 7.0, 'max': 9.0}]
+    for pipeline in [[{'$out': 'stolen'}],
+                     [{'$match': {'$where': 'sleep(1000)'}}],
+                     [{'$group': {'_id': None,
+                                  'x': {'$accumulator': {}}}}],
+                     {'$match': {}}]:
+        with pytest.raises(AnalysisstoreException):
+            astore.aggregate_data_reference(pipeline)
+
+
+def test_binary_arrays_stored_as_bson_binary(astore):
+    raw = bytes(range(16))
+    data = {'img': {'__ndarray__': base64.b64encode(raw).decode('ascii'),
+                    'dtype': '<f8', 'shape': [2]}}
+    uid = astore.insert_data_reference(time=time.time(), uid=str(uuid.uuid4()),
+                                       data_reference_header='dhdr',
+                                       data=dict(data), timestamps={})
+    stored = astore.database.data_reference.find_one({'uid': uid})
+    assert bytes(stored['data']['img']['__ndarray__']) == raw
+    res, = astore.find_data_reference(uid=uid)
+    assert res['data'] == data
+    with pytest.raises(AnalysisstoreException):
+        astore.insert_data_reference(time=time.time(), uid=str(uuid.uuid4()),
+                                     data_reference_header='dhdr',
+                                     data={'img': {'__ndarray__': '%%%',
+                                                   'dtype': '<f8',
+                                                   'shape': [2]}},
+                                     timestamps={})
+    # buffer length must match dtype and shape, object arrays are refused
+    for dtype, shape in [('<f8', [3]), ('<f4', [2, 3]), ('|O', [2]),
+                         ('<f8', [-2, -1])]:
+        with pytest.raises(AnalysisstoreException):
+            astore.insert_data_reference(
+                time=time.time(), uid=str(uuid.uuid4()),
+                data_reference_header='dhdr',
+                data={'img': dict(data['img'], dtype=dtype, shape=shape)},
+                timestamps={})
+    uid = astore.insert_data_reference(
+        time=time.time(), uid=str(uuid.uuid4()), data_reference_header='dhdr',
+        data={'img': dict(data['img'], dtype='<U1', shape=[4])}, timestamps={})
+
+
+@pytest.mark.parametrize("blob_store", ["gridfs", "directory"])
+def test_blob_offload(blob_store, tmp_path):
+    config = dict(uri="mongodb://localhost",
+                  database="astoretest{0}".format(str(uuid.uuid4())),
+                  blob_threshold=1024,
+                  blob_store="gridfs" if blob_store == "gridfs" else str(tmp_path))
+    astore = AStore(config, testing=True)
+    big = list(range(1000))
+    uid = astore.insert_data_reference(time=time.time(), uid=str(uuid.uuid4()),
+                                       data_reference_header='dhdr',
+                                       data={'big': big, 'small': 1},
+                                       timestamps={})
+    res, = astore.find_data_reference(uid=uid)
+    assert res['data']['small'] == 1
+    ref = res['data']['big']
+    assert set(ref) == {'__blob__', 'size'}
+    assert astore.get_data_reference_blob(ref['__blob__']) == {'value': big}
+    with pytest.raises(AnalysisstoreException):
+        astore.get_data_reference_blob('0' * 64)
+    astore = AStore(dict(config, blob_threshold=None), testing=True)
+    assert astore._blobs is None
+    with pytest.raises(AnalysisstoreException):
+        astore.get_data_reference_blob(ref['__blob__'])
+
+
+def test_compression():
+    config = dict(uri="mongodb://localhost",
+                  database="astoretest{0}".format(str(uuid.uuid4())),
+                  compression="zlib", compression_threshold=256)
+    astore = AStore(config, testing=True)
+    mask = {'mask': [0] * 1000, 'n': 3}
+    timestamps = {'mask': 1.5, 'n': 1.5}
+    uid = astore.insert_data_reference(time=time.time(), uid=str(uuid.uuid4()),
+                                       data_reference_header='dhdr',
+                                       data=dict(mask), timestamps=timestamps)
+    stored = astore.database.data_reference.find_one({'uid': uid})
+    # only the large value is compressed
+    assert stored['data']['mask']['__codec__'] == 'zlib'
+    assert stored['data']['n'] == 3
+    assert stored['timestamps'] == timestamps
+    res, = astore.find_data_reference(uid=uid)
+    assert res['data'] == mask
+    res, = astore.find_data_reference(uid=uid, fields=['data'])
+    assert res['data'] == mask
+    # small values stay queryable, large ones are returned whole
+    res, = astore.find_data_reference(fields=['data.n', 'data.mask'],
+                                      **{'data.n': 3})
+    assert res['data'] == mask
+    assert astore.count_data_reference(**{'$or': [{'timestamps.n': 1.5}]}) == 1
+    assert astore.distinct_data_reference('data.n') == [3]
+    assert astore.aggregate_data_reference(
+        [{'$group': {'_id': None, 'n': {'$max': '$data.n'}}}]) == [
+            {'_id': None, 'n': 3}]
+    # paths below a value are refused rather than matching nothing
+    for call in (lambda: astore.find_data_reference(fields=['data.mask.0']),
+                 lambda: astore.find_data_reference(**{'data.mask.0': 0}),
+                 lambda: astore.aggregate_data_reference(
+                     [{'$group': {'_id': '$data.mask.0'}}])):
+        with pytest.raises(AnalysisstoreException):
+            call()
+    with pytest.raises(AnalysisstoreException):
+        AStore(dict(config, compression='bogus'), testing=True)
+
+
+def test_bucketed_layout(monkeypatch):
+    config = dict(uri="mongodb://localhost",
+                  database="astoretest{0}".format(str(uuid.uuid4())))
+    plain = AStore(config, testing=True)
+    bucketed = AStore(dict(config, database=config['database'] + 'b',
+                           bucket_size=3), testing=True)
+    t0 = time.time()
+    drefs = [dict(time=t0 + i // 2, uid=str(uuid.uuid4()), data={'x': i % 3},
+                  timestamps={'x': t0}) for i in range(8)]
+    for astore in (plain, bucketed):
+        astore.ensure_indexes()
+        astore.bulk_data_reference_insert('dhdr', [dict(d) for d in drefs[:4]])
+        for d in drefs[4:]:
+            astore.insert_data_reference(data_reference_header='dhdr', **d)
+    # 8 references packed in 3 buckets
+    assert bucketed.database.data_reference_bucket.count_documents({}) == 3
+    assert bucketed.database.data_reference.count_documents({}) == 0
+
+    def pages(astore):
+        res, page = [], astore.find_data_reference(limit=3)
+        while True:
+            res.extend(page['data'])
+            if page['next'] is None:
+                return res
+            page = astore.find_data_reference(limit=3, next=page['next'])
+
+    assert (bucketed.find_data_reference(data_reference_header='dhdr') ==
+            plain.find_data_reference(data_reference_header='dhdr'))
+    assert pages(bucketed) == pages(plain)
+    # continuations skip the buckets holding only later references
+    page = bucketed.find_data_reference(data_reference_header='dhdr', limit=3)
+    spec = bucketed._find_command('data_reference', None, 3, page['next'],
+                                  {'data_reference_header': 'dhdr'})
+    assert spec['pipeline'][0]['$match'] == {
+        'data_reference_header': 'dhdr',
+        'time_min': {'$lte': page['data'][-1]['time']}}
+    uid = drefs[5]['uid']
+    assert (bucketed.find_data_reference(uid=uid, fields=['data.x']) ==
+            plain.find_data_reference(uid=uid, fields=['data.x']))
+    assert bucketed.count_data_reference(data_reference_header='dhdr') == 8
+    assert sorted(bucketed.distinct_data_reference('data.x')) == [0, 1, 2]
+    pipeline = [{'$group': {'_id': None, 'total': {'$sum': '$data.x'}}}]
+    assert (bucketed.aggregate_data_reference(pipeline) ==
+            plain.aggregate_data_reference(pipeline))
+    # a leading $match of the client selects buckets before unwinding
+    pipelines = []
+    coll_type = type(bucketed.database.data_reference_bucket)
+    aggregate = coll_type.aggregate
+    monkeypatch.setattr(coll_type, 'aggregate', lambda self, pipeline, **kw: (
+        pipelines.append(pipeline) or aggregate(self, pipeline, **kw)))
+    pipeline = [{'$match': {'data_reference_header': 'dhdr'}}] + pipeline
+    assert (bucketed.aggregate_data_reference(pipeline) ==
+            plain.aggregate_data_reference(pipeline))
+    assert pipelines[0][0] == {'$match': {'data_reference_header': 'dhdr'}}
+    assert pipelines[0][1] == {'$unwind': '$entries'}
+    monkeypatch.undo()
+    # duplicate uids, within the bulk and against stored buckets
+    new = dict(drefs[0], uid=str(uuid.uuid4()))
+    res = bucketed.bulk_data_reference_insert(
+        'dhdr', [dict(drefs[1]), dict(new), dict(new)])
+    assert res['inserted'] == [new['uid']]
+    assert sorted(f['uid'] for f in res['failed']) == sorted([drefs[1]['uid'],
+                                                              new['uid']])
+    with pytest.raises(AnalysisstoreException, match='Duplicate'):
+        bucketed.insert_data_reference(data_reference_header='dhdr', **drefs[2])
+    assert bucketed.count_data_reference() == 9
+    # a plain layout database must be migrated before bucket_size is set,
+    # mongomock clients do not share databases
+    monkeypatch.setattr(mongomock, 'MongoClient', lambda uri: plain.client)
+    with pytest.raises(AnalysisstoreException, match='migrate_to_buckets'):
+        AStore(dict(config, bucket_size=3), testing=True)
+    expected = plain.find_data_reference(data_reference_header='dhdr')
+    assert plain.migrate_to_buckets(3) == 8
+    migrated = AStore(dict(config, bucket_size=3), testing=True)
+    assert migrated.find_data_reference(data_reference_header='dhdr') == expected
+    assert plain.migrate_to_buckets(3) == 0
+
+
+@pytest.mark.parametrize('bucket_size', [None, 2])
+def test_data_reference_summary_backfill(astore, bucket_size):
+    astore._bucket_size = bucket_size
+    astore.ensure_indexes()
+    # stored before summaries and insert_seq existed
+    legacy = [dict(uid=str(uuid.uuid4()), time=10.0 + i, seq_num=i,
+                   data_reference_header='dhdr', data={}, timestamps={})
+              for i in range(3)]
+    if bucket_size:
+        astore._fill_buckets(astore.database.data_reference_bucket, 'dhdr',
+                             legacy, bucket_size)
+    else:
+        astore.database.data_reference.insert_many(legacy)
+    assert astore.get_data_reference_summary('dhdr') == dict(
+        data_reference_header='dhdr', count=3, time_min=10.0, time_max=12.0,
+        seq_num_min=0, seq_num_max=2)
+    new = dict(uid=str(uuid.uuid4()), data={}, timestamps={})
+    # a repeated uid is counted once, a missing time is not an error
+    res = astore.bulk_data_reference_insert('dhdr', [dict(new), dict(new)])
+    assert res['inserted'] == [new['uid']]
+    summary = astore.get_data_reference_summary('dhdr')
+    assert (summary['count'], summary['time_min'], summary['time_max']) == (
+        4, 10.0, 12.0)
+
+
+def test_query_shape():
+    shape = query_shape({'uid': 'abc', 'time': {'$gt': 5, '$lt': 6},
+                         '$or': [{'seq_num': {'$in': [1, 2]}}, {'x': 1}]})
+    assert shape == query_shape({'time': {'$lt': 0, '$gt': 1}, 'uid': 'd',
+                                 '$or': [{'seq_num': {'$in': [3]}},
+                                         {'x': 2}]})
+    assert shape == ('{"$or": [{"seq_num": {"$in": "?"}}, {"x": "?"}], '
+                     '"time": {"$gt": "?", "$lt": "?"}, "uid": "?"}')
+    # document lists are summarized and long shapes cut
+    docs = [{'uid': str(i), 'data': {'x': i}} for i in range(10000)]
+    assert query_shape({'docs': docs}) == '{"docs": "[10000 docs]"}'
+    shape = query_shape({'k{}'.format(i): i for i in range(1000)})
+    assert len(shape) == MAX_SHAPE_LENGTH
+    assert shape.endswith('...')
+
+
+def test_explain(astore):
+    with pytest.raises(AnalysisstoreException):
+        astore.explain('count_analysis_header', {})
+    with pytest.raises(AnalysisstoreException):
+        astore.explain('find_data_reference_bucket', {})
+    # options are validated before the backend is asked
+    with pytest.raises(AnalysisstoreException, match='limit'):
+        astore.explain('find_analysis_header', {'limit': -1})
+    # mongomock has no explain command
+    with pytest.raises(AnalysisstoreException, match='explain failed'):
+        astore.explain('find_analysis_header', {'uid': 'abc', 'limit': 1})
+
+
+@pytest.mark.parametrize('bucket_size', [None, 2])
+def test_find_since(astore, bucket_size):
+    astore._bucket_size = bucket_size
+    dhid = str(uuid.uuid4())
+    # inserted out of time order, polls follow insertion order
+    drefs = [dict(time=float(t), uid=str(uuid.uuid4()), data={}, timestamps={})
+             for t in (5, 3, 4)]
+    astore.bulk_data_reference_insert(dhid, drefs[:2])
+    astore.insert_data_reference(data_reference_header=str(uuid.uuid4()),
+                                 **dict(drefs[2], uid=str(uuid.uuid4())))
+    res = astore.find_data_reference(data_reference_header=dhid, since=0)
+    assert [d['time'] for d in res['data']] == [5.0, 3.0]
+    since = res['since']
+    assert astore.find_data_reference(data_reference_header=dhid,
+                                      since=since) == dict(data=[], since=since)
+    astore.insert_data_reference(data_reference_header=dhid, **drefs[2])
+    res = astore.find_data_reference(data_reference_header=dhid, since=since,
+                                     fields=['time'])
+    assert res['data'] == [dict(time=4.0, uid=drefs[2]['uid'],
+                                insert_seq=since + 2)]
+    res = astore.find_data_reference(data_reference_header=dhid, since=0,
+                                     limit=1)
+    assert res == dict(data=res['data'], since=res['data'][0]['insert_seq'])
+    # documents above an insert in progress are withheld
+    with astore._sequenced('data_reference', [{}],
+                           astore.database.data_reference):
+        astore.insert_data_reference(data_reference_header=dhid,
+                                     time=6.0, uid=str(uuid.uuid4()), data={},
+                                     timestamps={})
+        assert astore.find_data_reference(data_reference_header=dhid,
+                                          since=since + 2)['data'] == []
+    assert len(astore.find_data_reference(data_reference_header=dhid,
+                                          since=since + 2)['data']) == 1
+    # values come from a block reserved with a single counter round trip
+    counter = astore.database.counters.find_one({'_id': 'data_reference'})
+    assert counter['seq'] == astore_module.SEQ_BLOCK_SIZE
+    with pytest.raises(AnalysisstoreException):
+        astore.find_data_reference(since=-1)
+    with pytest.raises(AnalysisstoreException):
+        astore.find_data_reference(since=0, limit=1, next='abc')
+
+
+def test_validation():
+    astore = AStore(dict(uri="mongodb://localhost", validate=True,
+                         database="astoretest{0}".format(str(uuid.uuid4()))),
+                    testing=True)
+    with pytest.raises(AnalysisstoreException, match='provenance'):
+        astore.insert_analysis_header(time=time.time(), uid=str(uuid.uuid4()),
+                                      provenance='not an object')
+    dhid = str(uuid.uuid4())
+    drefs = [dict(time=time.time(), uid=str(uuid.uuid4()), data={'x': i},
+                  timestamps={'x': 0}, seq_num=i) for i in range(5)]
+    # one pass over a valid list
+    res = astore.bulk_data_reference_insert(dhid, drefs[:3])
+    assert res == dict(inserted=[d['uid'] for d in drefs[:3]], failed=[])
+    drefs[3]['seq_num'] = 'three'
+    res = astore.bulk_data_reference_insert(dhid, drefs[3:])
+    assert res['inserted'] == [drefs[4]['uid']]
+    assert [f['uid'] for f in res['failed']] == [drefs[3]['uid']]
+    with pytest.raises(AnalysisstoreException):
+        # seq_num is required
+        astore.insert_data_reference(time=time.time(), uid=str(uuid.uuid4()),
+                                     data_reference_header=dhid, data={},
+                                     timestamps={})
+    assert astore.count_data_reference() == 4
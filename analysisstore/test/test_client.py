@@ -3,6 +3,7 @@ from .conftest import testing_config
 import pytest
 import time
 import requests
+import threading
 import uuid
 
 
@@ -99,3 +100,295 @@ def test_dref_header_insert(astore_server, astore_client):
         data_keys={},
     )
     dh_id == dh_uid
+
+
+def test_header_find(astore_server, astore_client):
+    hid = generate_ahdr(astore_client)
+    res = astore_client.find_analysis_header(uid=hid)
+    assert len(res) == 1
+    assert res[0]["uid"] == hid
+
+
+def test_iter_analysis_header(astore_server, astore_client):
+    hids = {generate_ahdr(astore_client) for _ in range(5)}
+    res = list(astore_client.iter_analysis_header(page_size=2,
+                                                  uid={"$in": list(hids)}))
+    assert {d["uid"] for d in res} == hids
+    times = [d["time"] for d in res]
+    assert times == sorted(times, reverse=True)
+
+
+def test_stream_analysis_header(astore_server, astore_client):
+    hids = [generate_ahdr(astore_client) for _ in range(3)]
+    query = {"uid": {"$in": hids}}
+    res = list(astore_client.stream("analysis_header", query))
+    assert res == astore_client.find_analysis_header(**query)
+    assert len(res) == 3
+    # only find_* can be streamed
+    q = astore_client._query_factory(query, signature='count_analysis_header')
+    with pytest.raises(requests.exceptions.HTTPError) as err:
+        list(astore_client.get_stream(astore_client.aheader_url, q))
+    assert err.value.response.status_code == 400
+
+
+def test_bulk_data_reference_insert(astore_server, astore_client):
+    dh_id = astore_client.insert_data_reference_header(
+        analysis_header=generate_ahdr(astore_client),
+        time=time.time(),
+        uid=str(uuid.uuid4()),
+        data_keys={},
+    )
+    drefs = [
+        dict(uid=str(uuid.uuid4()), time=time.time(), data={"x": i},
+             timestamps={"x": 0})
+        for i in range(4)
+    ]
+    res = astore_client.bulk_data_reference_insert(dh_id, drefs)
+    assert res == dict(inserted=[d["uid"] for d in drefs], failed=[])
+    res = astore_client.bulk_data_reference_insert(dh_id, drefs[:1])
+    assert res["inserted"] == []
+    assert res["failed"][0]["uid"] == drefs[0]["uid"]
+
+
+def test_bulk_header_and_tail_insert(astore_server, astore_client):
+    hdrs = [dict(uid=str(uuid.uuid4()), time=time.time(), provenance={})
+            for _ in range(3)]
+    res = astore_client.bulk_analysis_header_insert(hdrs)
+    assert res == dict(inserted=[h["uid"] for h in hdrs], failed=[])
+    dhdrs = [dict(uid=str(uuid.uuid4()), time=time.time(),
+                  analysis_header=h["uid"], data_keys={}) for h in hdrs]
+    res = astore_client.bulk_data_reference_header_insert(dhdrs)
+    assert res["inserted"] == [d["uid"] for d in dhdrs]
+    tails = [dict(uid=str(uuid.uuid4()), time=time.time(),
+                  analysis_header=h, exit_status="success") for h in hdrs]
+    res = astore_client.bulk_analysis_tail_insert(tails)
+    assert res["inserted"] == [t["uid"] for t in tails]
+    assert len(astore_client.find_analysis_tail(
+        analysis_header=hdrs[0]["uid"])) == 1
+
+
+def test_count_and_distinct(astore_server, astore_client):
+    hid = generate_ahdr(astore_client)
+    for status in ["success", "success", "fail"]:
+        astore_client.insert_analysis_tail(uid=str(uuid.uuid4()),
+                                           analysis_header=hid,
+                                           time=time.time(),
+                                           exit_status=status)
+    assert astore_client.count_analysis_tail(analysis_header=hid) == 3
+    assert astore_client.count_analysis_tail(analysis_header="bogus") == 0
+    statuses = astore_client.distinct_analysis_tail("exit_status",
+                                                    analysis_header=hid)
+    assert sorted(statuses) == ["fail", "success"]
+
+
+def test_data_reference_arrays(astore_server, astore_client):
+    np = pytest.importorskip("numpy")
+    dh_id = astore_client.insert_data_reference_header(
+        analysis_header=generate_ahdr(astore_client),
+        time=time.time(),
+        uid=str(uuid.uuid4()),
+        data_keys={"img": {"dtype": "array", "shape": [3, 4]}},
+    )
+    img = np.arange(12, dtype="<f4").reshape(3, 4)
+    uid = astore_client.insert_data_reference(
+        dh_id, uid=str(uuid.uuid4()), time=time.time(),
+        data={"img": img, "total": 66.0}, timestamps={"img": 0, "total": 0},
+    )
+    res, = astore_client.find_data_reference(uid=uid)
+    assert res["data"]["total"] == 66.0
+    np.testing.assert_array_equal(res["data"]["img"], img)
+    assert res["data"]["img"].dtype == img.dtype
+    res, = astore_client.stream("data_reference", {"uid": uid})
+    np.testing.assert_array_equal(res["data"]["img"], img)
+    # 0-d arrays keep their shape, bulk inserts leave the documents as is
+    drefs = [dict(uid=str(uuid.uuid4()), time=time.time(),
+                  data={"img": img, "scalar": np.array(2.5)},
+                  timestamps={"img": 0, "scalar": 0})]
+    res = astore_client.bulk_data_reference_insert(dh_id, drefs)
+    assert res["inserted"] == [drefs[0]["uid"]]
+    assert drefs[0]["data"]["img"] is img
+    assert "data_reference_header" not in drefs[0]
+    res, = astore_client.find_data_reference(uid=drefs[0]["uid"])
+    assert res["data"]["scalar"].shape == ()
+    assert res["data"]["scalar"] == 2.5
+    np.testing.assert_array_equal(res["data"]["img"], img)
+    with pytest.raises(ValueError):
+        astore_client.insert_data_reference(
+            dh_id, uid=str(uuid.uuid4()), time=time.time(),
+            data={"img": np.array([1, "a"], dtype=object)},
+            timestamps={"img": 0})
+
+
+def test_data_reference_summary(astore_server, astore_client):
+    dh_id = astore_client.insert_data_reference_header(
+        analysis_header=generate_ahdr(astore_client),
+        time=time.time(),
+        uid=str(uuid.uuid4()),
+        data_keys={},
+    )
+    assert astore_client.get_data_reference_summary(dh_id)["count"] == 0
+    drefs = [dict(uid=str(uuid.uuid4()), time=100.0 + i, seq_num=i + 1,
+                  data={}, timestamps={}) for i in range(5)]
+    astore_client.bulk_data_reference_insert(dh_id, drefs[1:])
+    astore_client.insert_data_reference(dh_id, **drefs[0])
+    # failed duplicates are not counted
+    astore_client.bulk_data_reference_insert(dh_id, drefs[:1])
+    summary = astore_client.get_data_reference_summary(dh_id)
+    assert summary == dict(data_reference_header=dh_id, count=5,
+                           time_min=100.0, time_max=104.0,
+                           seq_num_min=1, seq_num_max=5)
+
+
+def test_analysis_tree(astore_server, astore_client):
+    ah_id = generate_ahdr(astore_client)
+    dh_ids = [astore_client.insert_data_reference_header(
+        analysis_header=ah_id, time=time.time(), uid=str(uuid.uuid4()),
+        data_keys={}) for _ in range(2)]
+    for dh_id in dh_ids:
+        astore_client.bulk_data_reference_insert(
+            dh_id, [dict(uid=str(uuid.uuid4()), time=float(i), data={},
+                         timestamps={}) for i in range(3)])
+    at_id = astore_client.insert_analysis_tail(analysis_header=ah_id,
+                                               time=time.time(),
+                                               uid=str(uuid.uuid4()),
+                                               exit_status='success')
+    tree = astore_client.get_analysis_tree(ah_id)
+    assert tree['analysis_header']['uid'] == ah_id
+    assert [t['uid'] for t in tree['analysis_tails']] == [at_id]
+    assert (set(d['uid'] for d in tree['data_reference_headers']) ==
+            set(dh_ids))
+    assert 'data_references' not in tree
+    tree = astore_client.get_analysis_tree(ah_id, include_references=True)
+    assert all(len(tree['data_references'][d]) == 3 for d in dh_ids)
+    tree = astore_client.get_analysis_tree(ah_id, include_references=2)
+    assert all([r['time'] for r in tree['data_references'][d]] == [2.0, 1.0]
+               for d in dh_ids)
+    with pytest.raises(requests.exceptions.HTTPError):
+        astore_client.get_analysis_tree(str(uuid.uuid4()))
+
+
+def test_response_cache(astore_cached_server, astore_cached_client):
+    ah_id = generate_ahdr(astore_cached_client)
+    hits = astore_cached_client.cache_stats()['response']['hits']
+    assert len(astore_cached_client.find_analysis_header(uid=ah_id)) == 1
+    assert len(astore_cached_client.find_analysis_header(uid=ah_id)) == 1
+    assert astore_cached_client.cache_stats()['response']['hits'] == hits + 1
+    # data references are not read by find_analysis_header
+    dh_id = astore_cached_client.insert_data_reference_header(
+        analysis_header=ah_id, time=time.time(), uid=str(uuid.uuid4()),
+        data_keys={})
+    astore_cached_client.insert_data_reference(
+        dh_id, uid=str(uuid.uuid4()), time=time.time(), data={},
+        timestamps={})
+    assert len(astore_cached_client.find_analysis_header(uid=ah_id)) == 1
+    assert astore_cached_client.cache_stats()['response']['hits'] == hits + 2
+    # inserting a tail invalidates the cached tree of its header
+    tree = astore_cached_client.get_analysis_tree(ah_id)
+    assert tree['analysis_tails'] == []
+    astore_cached_client.insert_analysis_tail(analysis_header=ah_id,
+                                       time=time.time(),
+                                       uid=str(uuid.uuid4()),
+                                       exit_status='success')
+    tree = astore_cached_client.get_analysis_tree(ah_id)
+    assert len(tree['analysis_tails']) == 1
+
+
+def test_metrics(astore_server, astore_client):
+    astore_client.count_analysis_header()
+    r = requests.get(astore_client._host_url + 'metrics')
+    r.raise_for_status()
+    assert r.headers['Content-Type'].startswith('text/plain')
+    assert ('analysisstore_requests_total{code="200",'
+            'handler="AnalysisHeaderHandler",method="GET",'
+            'signature="count_analysis_header"}') in r.text
+    labels = 'handler="AnalysisHeaderHandler",signature="count_analysis_header"'
+    assert ('analysisstore_request_duration_seconds_bucket{' + labels +
+            ',le="+Inf"}') in r.text
+    assert ('analysisstore_storage_duration_seconds_count'
+            '{signature="count_analysis_header"}') in r.text
+    assert 'analysisstore_ioloop_lag_seconds_count ' in r.text
+
+
+def test_subscribe(astore_server, astore_client):
+    ah_id = generate_ahdr(astore_client)
+    dh_id = astore_client.insert_data_reference_header(
+        analysis_header=ah_id, time=time.time(), uid=str(uuid.uuid4()),
+        data_keys={})
+    other = astore_client.insert_data_reference_header(
+        analysis_header=ah_id, time=time.time(), uid=str(uuid.uuid4()),
+        data_keys={})
+    with astore_client.subscribe(data_reference_header=dh_id,
+                                 timeout=5) as sub, \
+            astore_client.subscribe(analysis_header=ah_id, timeout=5) as asub:
+        astore_client.insert_data_reference(other, uid=str(uuid.uuid4()),
+                                            time=1.0, data={}, timestamps={})
+        drefs = [dict(uid=str(uuid.uuid4()), time=float(i), data={'x': i},
+                      timestamps={'x': 0}) for i in range(3)]
+        astore_client.bulk_data_reference_insert(dh_id, drefs)
+        # failed duplicates are not pushed
+        astore_client.bulk_data_reference_insert(dh_id, drefs[:1])
+        astore_client.insert_data_reference(dh_id, uid=str(uuid.uuid4()),
+                                            time=3.0, data={'x': 3},
+                                            timestamps={'x': 0})
+        received = [next(sub) for _ in range(4)]
+        assert [d['data']['x'] for _, d in received] == [0, 1, 2, 3]
+        assert all(t == 'data_reference' and
+                   d['data_reference_header'] == dh_id for t, d in received)
+        at_id = astore_client.insert_analysis_tail(
+            analysis_header=ah_id, time=time.time(), uid=str(uuid.uuid4()),
+            exit_status='success')
+        received = [next(asub) for _ in range(6)]
+        assert [t for t, _ in received] == ['data_reference'] * 5 + [
+            'analysis_tail']
+        assert received[0][1]['data_reference_header'] == other
+        assert received[-1][1]['uid'] == at_id
+
+
+def test_find_since(astore_server, astore_client):
+    ah_id = generate_ahdr(astore_client)
+    res = astore_client.find_analysis_tail(analysis_header=ah_id, since=0)
+    assert res['data'] == []
+    at_id = astore_client.insert_analysis_tail(analysis_header=ah_id,
+                                               time=time.time(),
+                                               uid=str(uuid.uuid4()),
+                                               exit_status='success')
+    res = astore_client.find_analysis_tail(analysis_header=ah_id,
+                                           since=res['since'])
+    assert [d['uid'] for d in res['data']] == [at_id]
+    assert astore_client.find_analysis_tail(
+        analysis_header=ah_id, since=res['since'])['data'] == []
+
+
+def test_wait_analysis_tail(astore_server, astore_client):
+    ah_id = generate_ahdr(astore_client)
+    start = time.monotonic()
+    assert astore_client.wait_analysis_tail(ah_id, timeout=0.2) is None
+    assert time.monotonic() - start >= 0.2
+    at_id = str(uuid.uuid4())
+
+    def finish():
+        time.sleep(0.3)
+        AnalysisClient(dict(host=astore_client.host,
+                            port=astore_client.port)).insert_analysis_tail(
+            analysis_header=ah_id, time=time.time(), uid=at_id,
+            exit_status='success')
+
+    thread = threading.Thread(target=finish)
+    thread.start()
+    start = time.monotonic()
+    tail = astore_client.wait_analysis_tail(ah_id, timeout=10)
+    thread.join()
+    assert tail['uid'] == at_id
+    # woken by the insert rather than by the periodic recheck
+    assert time.monotonic() - start < 0.3 + 0.9
+    assert astore_client.wait_analysis_tail(ah_id, timeout=10)['uid'] == at_id
+    q = astore_client._query_factory(dict(uid=ah_id, timeout=-1),
+                                     signature='wait_analysis_tail')
+    with pytest.raises(requests.exceptions.HTTPError):
+        astore_client.get(astore_client.atail_url, q)
+    # only find_* can be streamed
+    q = astore_client._query_factory(dict(uid=ah_id),
+                                     signature='wait_analysis_tail')
+    with pytest.raises(requests.exceptions.HTTPError) as err:
+        list(astore_client.get_stream(astore_client.atail_url, q))
+    assert err.value.response.status_code == 400
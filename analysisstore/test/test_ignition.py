@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import urllib.parse
+import uuid
+
+import pytest
+import ujson
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from ..ignition import make_application, start_server
+from ..server.cache import DEFAULT_UID_CACHE_SIZE
+
+
+def make_config(**kwargs):
+    return dict(mongo_uri="mongodb://localhost",
+                database="astoretest{0}".format(str(uuid.uuid4())),
+                testing=True, **kwargs)
+
+
+def serve(app):
+    """Serve app on an unused port of the running IOLoop, return the server
+    and its url"""
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    return server, 'http://localhost:{}/'.format(port)
+
+
+def query_url(url, path, signature, payload):
+    query = ujson.dumps(dict(signature=signature, payload=payload))
+    return url + path + '?' + urllib.parse.quote(query)
+
+
+def test_slow_storage_call_does_not_block():
+    app = make_application(make_config(storage_pool_size=2))
+    assert app.settings['executor']._max_workers == 2
+    astore = app.settings['astore']
+    release = threading.Event()
+
+    def find_analysis_header(**kwargs):
+        release.wait(10)
+        return []
+
+    # queryables are resolved from the AStore on every request
+    astore.find_analysis_header = find_analysis_header
+
+    async def run():
+        server, url = serve(app)
+        client = AsyncHTTPClient()
+        slow = asyncio.ensure_future(client.fetch(query_url(
+            url, 'analysis_header', 'find_analysis_header', {})))
+        fast = await client.fetch(query_url(
+            url, 'analysis_header', 'count_analysis_header', {}))
+        # answered while the slow call still holds a storage thread
+        assert ujson.loads(fast.body) == 0
+        assert not slow.done()
+        release.set()
+        assert ujson.loads((await slow).body) == []
+        server.stop()
+
+    try:
+        asyncio.run(run())
+    finally:
+        release.set()
+        app.settings['executor'].shutdown()
+
+
+def test_parent_cache_size():
+    app = make_application(make_config(header_cache_size=0))
+    parents = app.settings['subscriptions']._parents
+    assert parents.maxsize == DEFAULT_UID_CACHE_SIZE
+    app = make_application(make_config(parent_cache_size=5))
+    assert app.settings['subscriptions']._parents.maxsize == 5
+
+
+def test_workers_refuse_response_cache():
+    # refused before binding or forking
+    with pytest.raises(ValueError):
+        start_server(make_config(workers=2, response_cache_size=1 << 20,
+                                 service_port=7603, log_file_prefix=None))
+
+
+def test_workers_refuse_since():
+    app = make_application(make_config(workers=2))
+
+    async def run():
+        server, url = serve(app)
+        client = AsyncHTTPClient()
+        with pytest.raises(HTTPClientError) as err:
+            await client.fetch(query_url(url, 'analysis_tail',
+                                         'find_analysis_tail', dict(since=0)))
+        assert err.value.code == 400
+        res = await client.fetch(query_url(url, 'analysis_tail',
+                                           'find_analysis_tail', {}))
+        assert ujson.loads(res.body) == []
+        server.stop()
+
+    try:
+        asyncio.run(run())
+    finally:
+        app.settings['executor'].shutdown()
@@ -0,0 +1,66 @@
+"""Compression ratio and CPU cost of the data_reference payload codecs.
+
+Encodes typical payloads the way AStore stores them (BSON per value, then
+the codec) and reports the stored size relative to the uncompressed BSON
+together with the time spent compressing and decompressing per document.
+Many small values, such as per key timestamps, are left uncompressed::
+
+    python benchmarks/compression.py
+"""
+import argparse
+import random
+import time as ttime
+
+import bson
+
+from analysisstore.server.payload import (CODECS, compress_values,
+                                          decompress_values)
+
+
+def payloads(n):
+    """Named (data, timestamps) pairs of n elements"""
+    t0 = ttime.time()
+    mask = [1 if 400 < i % 1000 < 600 else 0 for i in range(n)]
+    sparse = [0.0] * n
+    for i in random.sample(range(n), n // 100):
+        sparse[i] = random.random()
+    noise = [random.gauss(0, 1) for _ in range(n)]
+    return [('mask', {'mask': mask}, {'mask': t0}),
+            ('sparse floats', {'sparse': sparse}, {'sparse': t0}),
+            ('random floats', {'noise': noise}, {'noise': t0}),
+            ('repeated timestamps', {'x': list(range(n))},
+             {'x%d' % i: t0 for i in range(n // 10)})]
+
+
+def bench(codec, data, repeat):
+    raw = len(bson.encode(data))
+    t0 = ttime.perf_counter()
+    for _ in range(repeat):
+        stored = compress_values(dict(data), codec, 0)
+    compress = (ttime.perf_counter() - t0) / repeat
+    t0 = ttime.perf_counter()
+    for _ in range(repeat):
+        decompress_values(dict(stored))
+    decompress = (ttime.perf_counter() - t0) / repeat
+    return len(bson.encode(stored)) / raw, compress, decompress
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=100000,
+                        help='elements per payload')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    print('{:<22}{:<16}{:>8}{:>16}{:>18}'.format('payload', 'codec', 'ratio',
+                                                 'compress ms', 'decompress ms'))
+    for name, data, timestamps in payloads(args.n):
+        for field, value in (('data', data), ('timestamps', timestamps)):
+            for codec in sorted(CODECS):
+                ratio, comp, decomp = bench(codec, value, args.repeat)
+                print('{:<22}{:<16}{:>8.3f}{:>16.2f}{:>18.2f}'.format(
+                    name, '{} {}'.format(codec, field), ratio,
+                    comp * 1e3, decomp * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Cost of schema validation on bulk data_reference inserts.
+
+Compares validating every document with jsonschema.validate, which checks
+the schema again on each call, against the validators AStore compiles once
+(fastjsonschema if installed, jsonschema otherwise), called per document
+and once per list. Then reports the overhead validation adds to
+bulk_data_reference_insert on a local mongod (default) or, with --testing,
+the mongomock backend::
+
+    python benchmarks/validation.py --mongo_uri mongodb://localhost
+    python benchmarks/validation.py --testing
+"""
+import argparse
+import time as ttime
+import uuid
+
+import jsonschema
+
+from analysisstore.server import validation
+from analysisstore.server.astore import AStore
+from analysisstore.server.utils import schemas
+
+
+def make_refs(dhdr, n):
+    return [dict(time=ttime.time(), uid=str(uuid.uuid4()),
+                 data_reference_header=dhdr, data={'x': i, 'y': [i] * 16},
+                 timestamps={'x': ttime.time(), 'y': ttime.time()}, seq_num=i)
+            for i in range(n)]
+
+
+def timed(func, *args):
+    t0 = ttime.perf_counter()
+    func(*args)
+    return ttime.perf_counter() - t0
+
+
+def bench_validators(n):
+    refs = make_refs(str(uuid.uuid4()), n)
+    schema = schemas['data_reference']
+    validators = validation.compile_validators()
+    single, bulk = validators['data_reference'], validators['bulk_data_reference']
+
+    def naive():
+        for ref in refs:
+            jsonschema.validate(ref, schema)
+
+    def compiled():
+        for ref in refs:
+            single(ref)
+
+    return [('jsonschema.validate per doc', timed(naive)),
+            ('compiled per doc', timed(compiled)),
+            ('compiled, one pass', timed(bulk, refs))]
+
+
+def bench_insert(args, validate):
+    database = 'astorebench{}'.format(uuid.uuid4())
+    astore = AStore(dict(uri=args.mongo_uri, database=database,
+                         validate=validate), testing=args.testing)
+    astore.ensure_indexes()
+    try:
+        dhdr = str(uuid.uuid4())
+        refs = make_refs(dhdr, args.n)
+        return timed(astore.bulk_data_reference_insert, dhdr, refs)
+    finally:
+        astore.client.drop_database(database)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo_uri', default='mongodb://localhost')
+    parser.add_argument('--testing', action='store_true',
+                        help='use the mongomock backend')
+    parser.add_argument('-n', type=int, default=10000,
+                        help='documents per bulk')
+    args = parser.parse_args()
+    backend = 'fastjsonschema' if validation.fastjsonschema else 'jsonschema'
+    print('{} documents, compiled with {}'.format(args.n, backend))
+    print('{:<32}{:>12}{:>14}'.format('validation', 'ms', 'us/doc'))
+    for label, seconds in bench_validators(args.n):
+        print('{:<32}{:>12.1f}{:>14.1f}'.format(label, seconds * 1e3,
+                                                seconds / args.n * 1e6))
+    plain = bench_insert(args, False)
+    validated = bench_insert(args, True)
+    print('bulk_data_reference_insert {:.1f} ms, {:.1f} ms validated '
+          '({:+.0%})'.format(plain * 1e3, validated * 1e3,
+                             validated / plain - 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Insert throughput of AStore under different write concerns.
+
+Run against a local mongod (default) or, with --testing, the mongomock backend
+used by the test suite, which ignores write concerns and only serves as a
+baseline of the python side cost::
+
+    python benchmarks/write_concern.py --mongo_uri mongodb://localhost
+    python benchmarks/write_concern.py --testing
+"""
+import argparse
+import time as ttime
+import uuid
+
+from analysisstore.server.astore import AStore
+
+WRITE_CONCERNS = [('w=1 (default)', None),
+                  ('w=1, j=True', {'w': 1, 'j': True}),
+                  ('w=0 (unacknowledged)', {'w': 0})]
+
+
+def make_refs(dhdr, n):
+    return [dict(time=ttime.time(), uid=str(uuid.uuid4()),
+                 data_reference_header=dhdr, data={'x': i, 'y': [i] * 16},
+                 timestamps={'x': ttime.time(), 'y': ttime.time()}, seq_num=i)
+            for i in range(n)]
+
+
+def bench(astore, n, write_concern):
+    # start every measurement from an empty collection
+    astore.database.data_reference.delete_many({})
+    dhdr = str(uuid.uuid4())
+    refs = make_refs(dhdr, n)
+    t0 = ttime.perf_counter()
+    for ref in refs:
+        astore.insert_data_reference(write_concern=write_concern, **ref)
+    single = n / (ttime.perf_counter() - t0)
+    astore.database.data_reference.delete_many({})
+    refs = make_refs(dhdr, n)
+    t0 = ttime.perf_counter()
+    astore.bulk_data_reference_insert(dhdr, refs, write_concern=write_concern)
+    bulk = n / (ttime.perf_counter() - t0)
+    return single, bulk
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mongo_uri', default='mongodb://localhost')
+    parser.add_argument('--testing', action='store_true',
+                        help='use the mongomock backend')
+    parser.add_argument('-n', type=int, default=5000,
+                        help='documents inserted per measurement')
+    args = parser.parse_args()
+    database = 'astorebench{}'.format(uuid.uuid4())
+    astore = AStore(dict(uri=args.mongo_uri, database=database),
+                    testing=args.testing)
+    astore.ensure_indexes()
+    try:
+        print('{:<24}{:>16}{:>16}'.format('write concern', 'insert docs/s',
+                                          'bulk docs/s'))
+        for label, wc in WRITE_CONCERNS:
+            single, bulk = bench(astore, args.n, wc)
+            print('{:<24}{:>16.0f}{:>16.0f}'.format(label, single, bulk))
+    finally:
+        astore.client.drop_database(database)
+
+
+if __name__ == '__main__':
+    main()